@@ -2,10 +2,43 @@ import streamlit as st
 import pandas as pd
 from datetime import date, timedelta
 import time
-import gspread
+import threading
+import random
+import uuid
+import queue
+import itertools
+import collections
+import bisect
+import re
+import unicodedata
+import os
+import importlib
+import json
+import hashlib
+import io
+import logging
+import contextlib
+import contextvars
+import sqlite3
+import tempfile
+import tenacity
 import numpy as np
-import altair as alt
-import requests
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# gspread (que traz o requests) e o Altair somam mais de meio segundo de import: só são
+# carregados no primeiro uso, que normalmente é o aquecimento em segundo plano
+class _LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+gspread = _LazyModule('gspread')
+requests = _LazyModule('requests')
+alt = _LazyModule('altair')
 
 # ==============================================================================
 # 1. CONFIGURAÇÃO E CONEXÃO
@@ -14,154 +47,2552 @@ import requests
 SHEET_ID = '1BNjgWhvEj8NbnGr4x7F42LW7QbQiG5kZ1FBhfr9Q-4g'
 PLANILHA_TITULO = 'Dados Automóvel'
 
-EXPECTED_COLS = {
-    'veiculo': ['id_veiculo', 'nome', 'placa', 'ano', 'valor_pago', 'data_compra'],
-    'prestador': ['id_prestador', 'empresa', 'telefone', 'nome_prestador', 'cnpj', 'email', 'endereco', 'numero', 'cidade', 'bairro', 'cep'],
-    'servico': ['id_servico', 'id_veiculo', 'id_prestador', 'nome_servico', 'data_servico', 'garantia_dias', 'valor', 'km_realizado', 'km_proxima_revisao', 'registro', 'data_vencimento']
+# Frotas servidas por este processo: FROTAS='{"Nome": "id da planilha", ...}'. Sem isso,
+# uma frota só, a planilha acima. Só as planilhas listadas aqui podem ser abertas.
+TENANTS = json.loads(os.environ.get('FROTAS') or 'null') or {'Frota': SHEET_ID}
+DEFAULT_TENANT = next(iter(TENANTS.values()))
+TENANT_CACHE_MB = float(os.environ.get('TENANT_CACHE_MB', 1024))
+
+# Esquema declarativo: tipo, se aceita vazio e valor padrão de cada coluna. Os valores
+# são convertidos uma única vez, na carga, para tipos compactos (ids int32, nomes como
+# category, datas datetime64); quem consome já recebe tudo tipado. Dinheiro fica em
+# float64: em float32, 1234.56 voltaria à planilha como 1234.56005859375.
+Column = collections.namedtuple('Column', ['dtype', 'nullable', 'default'])
+
+SCHEMA = {
+    'veiculo': {
+        'id_veiculo': Column('int32', False, 0),
+        'nome': Column('category', False, ''),
+        'placa': Column('category', False, ''),
+        'ano': Column('Int16', True, None),
+        'valor_pago': Column('float64', False, 0.0),
+        'data_compra': Column('datetime64[ns]', True, None),
+    },
+    'prestador': {
+        'id_prestador': Column('int32', False, 0),
+        'empresa': Column('category', False, ''),
+        'telefone': Column('object', False, ''),
+        'nome_prestador': Column('object', False, ''),
+        'cnpj': Column('object', False, ''),
+        'email': Column('object', False, ''),
+        'endereco': Column('object', False, ''),
+        'numero': Column('object', False, ''),
+        'cidade': Column('category', False, ''),
+        'bairro': Column('object', False, ''),
+        'cep': Column('object', False, ''),
+    },
+    'servico': {
+        'id_servico': Column('int32', False, 0),
+        'id_veiculo': Column('int32', False, 0),
+        'id_prestador': Column('int32', False, 0),
+        'nome_servico': Column('object', False, ''),
+        'data_servico': Column('datetime64[ns]', True, None),
+        'garantia_dias': Column('Int16', True, None),
+        'valor': Column('float64', False, 0.0),
+        'km_realizado': Column('Int32', True, None),
+        'km_proxima_revisao': Column('Int32', True, None),
+        'registro': Column('object', False, ''),
+        'data_vencimento': Column('datetime64[ns]', True, None),
+    },
 }
 
+EXPECTED_COLS = {sheet_name: list(cols) for sheet_name, cols in SCHEMA.items()}
+
+def coerce_series(series, column):
+    if str(series.dtype) == column.dtype:
+        return series
+    if column.dtype == 'datetime64[ns]':
+        # Aceita tanto ISO (2024-01-31) quanto o formato exibido pela planilha (31/01/2024)
+        return pd.to_datetime(series.replace("", None), errors='coerce', format='mixed', dayfirst=True)
+    if column.dtype in ('int32', 'Int16', 'Int32', 'float64'):
+        values = pd.to_numeric(series.replace("", None), errors='coerce')
+        if column.default is not None: values = values.fillna(column.default)
+        if column.dtype != 'float64': values = values.round()
+        return values.astype(column.dtype)
+    values = series.where(series.notna(), column.default).astype(str)
+    return values.astype('category') if column.dtype == 'category' else values
+
+def coerce_frame(sheet_name, df):
+    schema = SCHEMA.get(sheet_name, {})
+    out = {col: coerce_series(df[col], schema[col]) if col in schema else df[col] for col in df.columns}
+    for col, column in schema.items():
+        if col not in out:
+            out[col] = coerce_series(pd.Series([column.default] * len(df), index=df.index, dtype=object), column)
+    return pd.DataFrame(out, index=df.index)
+
+def empty_frame(sheet_name):
+    return coerce_frame(sheet_name, pd.DataFrame(columns=EXPECTED_COLS.get(sheet_name, [])))
+
+def coerce_value(sheet_name, col, value):
+    column = SCHEMA.get(sheet_name, {}).get(col)
+    if column is None: return value
+    return coerce_series(pd.Series([value], dtype=object), column).iloc[0]
+
+# Concatena mantendo as colunas category (pd.concat viraria object se as categorias diferirem)
+def concat_typed(frames):
+    frames = [f for f in frames if not f.empty] or frames[:1]
+    if len(frames) > 1:
+        for col in frames[0].columns:
+            if not isinstance(frames[0][col].dtype, pd.CategoricalDtype): continue
+            if not all(col in f.columns and isinstance(f[col].dtype, pd.CategoricalDtype) for f in frames): continue
+            cats = frames[0][col].cat.categories
+            for f in frames[1:]: cats = cats.union(f[col].cat.categories)
+            frames = [f.assign(**{col: f[col].cat.set_categories(cats)}) if not f[col].cat.categories.equals(cats) else f for f in frames]
+    return pd.concat(frames, ignore_index=True)
+
+# ------------------------------------------------------------------------------
+# Instrumentação: tempo e contagem de cada chamada à API, acertos/erros de cache e
+# duração das etapas da tela. Custa um perf_counter e um lock por evento, então fica
+# sempre ligada. O resumo aparece no painel "Desempenho" da barra lateral; com
+# METRICS_LOG definido, cada evento também vira uma linha JSON no log.
+# ------------------------------------------------------------------------------
+METRICS_SAMPLES = 256
+metrics_log = logging.getLogger('metrics')
+if os.environ.get('METRICS_LOG') and not metrics_log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    metrics_log.addHandler(_handler)
+    metrics_log.setLevel(logging.INFO)
+    metrics_log.propagate = False
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.caches = collections.defaultdict(collections.Counter)
+        self.since = time.time()
+
+    def record(self, kind, name, seconds, ok=True):
+        with self.lock:
+            stat = self.timings.get((kind, name))
+            if stat is None:
+                stat = self.timings[(kind, name)] = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0,
+                                                     'samples': collections.deque(maxlen=METRICS_SAMPLES)}
+            stat['count'] += 1
+            stat['errors'] += not ok
+            stat['total'] += seconds
+            stat['max'] = max(stat['max'], seconds)
+            stat['samples'].append(seconds)
+        if metrics_log.isEnabledFor(logging.INFO):
+            metrics_log.info(json.dumps({'ts': round(time.time(), 3), 'kind': kind, 'name': name, 'ms': round(seconds * 1000, 2), 'ok': ok}))
+
+    def cache(self, name, outcome):
+        with self.lock:
+            self.caches[name][outcome] += 1
+        if metrics_log.isEnabledFor(logging.INFO):
+            metrics_log.info(json.dumps({'ts': round(time.time(), 3), 'kind': 'cache', 'name': name, 'outcome': outcome}))
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+            self.caches.clear()
+            self.since = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            timings = []
+            for (kind, name), stat in self.timings.items():
+                samples = np.array(stat['samples']) * 1000
+                timings.append({
+                    'tipo': kind, 'nome': name, 'chamadas': stat['count'], 'erros': stat['errors'],
+                    'total_ms': round(stat['total'] * 1000, 1), 'media_ms': round(stat['total'] * 1000 / stat['count'], 1),
+                    'p50_ms': round(float(np.percentile(samples, 50)), 1), 'p95_ms': round(float(np.percentile(samples, 95)), 1),
+                    'max_ms': round(stat['max'] * 1000, 1),
+                })
+            caches = []
+            for name, counts in self.caches.items():
+                total = sum(counts.values())
+                caches.append({'cache': name, **counts, 'taxa_acerto': round(counts['hit'] / total, 3) if total else None})
+            return {'desde': self.since, 'tempos': timings, 'caches': caches}
+
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+# ------------------------------------------------------------------------------
+# Governador de requisições: toda chamada ao gspread tira uma ficha de um balde do
+# tamanho da cota por minuto da API e erros transitórios são repetidos com espera
+# exponencial e jitter. 429 sempre pode ser repetido (a API recusou a requisição);
+# 5xx e falhas de rede só nas operações idempotentes, para não duplicar um append
+# nem apagar duas vezes a mesma posição de linha.
+# ------------------------------------------------------------------------------
+SHEETS_QUOTA_PER_MIN = int(os.environ.get('SHEETS_QUOTA_PER_MIN', 60))
+SHEETS_MAX_ATTEMPTS = 5
+IDEMPOTENT_OPS = {'auth', 'open', 'open_by_key', 'worksheet', 'values_batch_get', 'get_all_values',
+                  'batch_get', 'row_values', 'col_values', 'update', 'batch_update', 'resize'}
+
+class SheetReadError(Exception):
+    # A leitura falhou: diferente de uma aba vazia, e nada deve ser gravado com base nela
+    pass
+
+class TokenBucket:
+    def __init__(self, rate_per_min=SHEETS_QUOTA_PER_MIN):
+        self.rate = rate_per_min / 60.0
+        self.capacity = float(rate_per_min)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1, take=True):
+        # Bloqueia até haver n fichas; devolve quanto tempo esperou (take=False só espera)
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    if take: self.tokens -= n
+                    return waited
+                delay = (n - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def drain(self):
+        # A API respondeu 429: a cota real acabou antes da nossa conta, todos esperam
+        with self.lock:
+            self.tokens = min(self.tokens, 0.0)
+
+@st.cache_resource
+def get_request_governor():
+    return TokenBucket()
+
+def _status_code(e):
+    return getattr(getattr(e, 'response', None), 'status_code', None)
+
+def _is_transient(e, op):
+    if isinstance(e, gspread.exceptions.APIError):
+        code = _status_code(e) or 0
+        return code == 429 or (code >= 500 and op in IDEMPOTENT_OPS)
+    return isinstance(e, (requests.ConnectionError, requests.Timeout)) and op in IDEMPOTENT_OPS
+
+# Ponto único por onde passam as chamadas ao gspread
+def _gspread_call(op, fn, *args, **kwargs):
+    governor = get_request_governor()
+    metrics = get_metrics()
+    retrying = tenacity.Retrying(
+        stop=tenacity.stop_after_attempt(SHEETS_MAX_ATTEMPTS),
+        wait=tenacity.wait_random_exponential(multiplier=0.5, max=30),
+        retry=tenacity.retry_if_exception(lambda e: _is_transient(e, op)),
+        before_sleep=lambda state: metrics.record('retentativa', op, state.upcoming_sleep),
+        reraise=True,
+    )
+    for attempt in retrying:
+        with attempt:
+            waited = governor.acquire()
+            if waited: metrics.record('cota', 'espera', waited)
+            t0 = time.perf_counter()
+            ok = True
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                ok = False
+                if _status_code(e) == 429: governor.drain()
+                raise
+            finally:
+                metrics.record('gspread', op, time.perf_counter() - t0, ok)
+
+@contextlib.contextmanager
+def timed(name, kind='etapa'):
+    t0 = time.perf_counter()
+    ok = True
+    try:
+        yield
+    except Exception:
+        ok = False
+        raise
+    finally:
+        get_metrics().record(kind, name, time.perf_counter() - t0, ok)
+
 @st.cache_resource(ttl=3600)
 def get_gspread_client():
+    # GSPREAD_CLIENT_FACTORY="modulo:funcao" troca o cliente real por outro (ex.: benchmark.py)
+    factory = os.environ.get('GSPREAD_CLIENT_FACTORY')
+    if factory:
+        module_name, _, func_name = factory.partition(':')
+        return getattr(importlib.import_module(module_name), func_name)()
     try:
         creds_info = st.secrets["gcp_service_account"]
-        gc = gspread.service_account_from_dict(creds_info)
+        gc = _gspread_call('auth', gspread.service_account_from_dict, creds_info)
         return gc
     except Exception as e:
         st.error(f"Erro Crítico de Autenticação: {e}")
         st.stop()
 
+# ------------------------------------------------------------------------------
+# Frotas: a planilha em uso vem da sessão (seletor / ?frota= na URL) ou, nas threads de
+# fundo, da frota de quem as criou. Tudo o que é de uma planilha (handles, cópias das
+# abas, visão consolidada, derivados, índices, fila de gravação) fica num LRU único,
+# por frota, com orçamento de memória: passou de TENANT_CACHE_MB, as frotas usadas há
+# mais tempo perdem os dados em memória e os recarregam quando voltarem.
+# ------------------------------------------------------------------------------
+
+_tenant_var = contextvars.ContextVar('frota', default=None)
+
+def current_tenant():
+    tenant = _tenant_var.get()
+    if tenant is not None: return tenant
+    if len(TENANTS) == 1: return DEFAULT_TENANT
+    return TENANTS.get(st.session_state.get('frota'), DEFAULT_TENANT)
+
+# Threads de fundo não enxergam a sessão: levam junto a frota de quem as criou
+def in_tenant(fn, tenant=None):
+    tenant = current_tenant() if tenant is None else tenant
+    def run(*args, **kwargs):
+        token = _tenant_var.set(tenant)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _tenant_var.reset(token)
+    return run
+
+# Nome de arquivo e de thread da frota: um resumo do id, que não junta ids diferentes
+# (trocar '-' por '_' juntaria) e serve em qualquer sistema de arquivos
+def tenant_slug(tenant=None):
+    tenant = (current_tenant() if tenant is None else tenant) or PLANILHA_TITULO
+    return hashlib.sha1(tenant.encode('utf-8')).hexdigest()[:16]
+
+# Ao sair da memória a frota perde os handles e os índices, e os recursos com release()
+# soltam seus dados; fila de gravação, réplica, alocador de ids e aquecimento ficam,
+# porque guardam trabalho em andamento (e são pequenos).
+TENANT_DISPOSABLE = ('planilha', 'manutencao', 'busca')
+
+class TenantStore:
+    def __init__(self, budget_mb=TENANT_CACHE_MB):
+        self.budget = budget_mb * 2 ** 20
+        self.lock = threading.RLock()
+        self.tenants = collections.OrderedDict()           # frota -> {recurso: objeto}, da menos à mais recente
+
+    def resource(self, tenant, name, factory):
+        with self.lock:
+            resources = self.tenants.setdefault(tenant, {})
+            self.tenants.move_to_end(tenant)
+            if name not in resources: resources[name] = factory()
+            return resources[name]
+
+    def get(self, tenant, name):
+        with self.lock:
+            return self.tenants.get(tenant, {}).get(name)
+
+    def put(self, tenant, name, value):
+        with self.lock:
+            self.tenants.setdefault(tenant, {})[name] = value
+            return value
+
+    # Bytes em DataFrames/arrays que cada frota segura (os índices não entram na conta)
+    def usage(self):
+        with self.lock:
+            tenants = [(tenant, list(resources.values())) for tenant, resources in self.tenants.items()]
+        return collections.OrderedDict(
+            (tenant, sum(r.nbytes() for r in resources if hasattr(r, 'nbytes'))) for tenant, resources in tenants
+        )
+
+    def trim(self, keep=None):
+        usage = self.usage()
+        total = sum(usage.values())
+        for tenant, size in usage.items():
+            if total <= self.budget: break
+            if tenant == keep or not size: continue
+            self.evict(tenant)
+            total -= size
+            get_metrics().cache('frotas', 'despejo')
+        return total
+
+    def evict(self, tenant):
+        with self.lock:
+            resources = self.tenants.get(tenant, {})
+            for name in TENANT_DISPOSABLE: resources.pop(name, None)
+            held = list(resources.values())
+        for resource in held:
+            if hasattr(resource, 'release'): resource.release()
+
+@st.cache_resource
+def get_tenant_store():
+    return TenantStore()
+
+def tenant_resource(name, factory):
+    return get_tenant_store().resource(current_tenant(), name, factory)
+
+# Bytes ocupados por DataFrames/Series/arrays, inclusive dentro de dicts, listas e tuplas
+def estimate_nbytes(value):
+    if isinstance(value, pd.DataFrame): return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)): return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray): return value.nbytes
+    if isinstance(value, dict): return sum(estimate_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)): return sum(estimate_nbytes(v) for v in value)
+    return 0
+
+# Handles da planilha da frota atual: (cliente, planilha, {aba: worksheet}). Reabertos
+# quando o cliente é renovado (TTL do get_gspread_client)
+def _spreadsheet_handles():
+    gc = get_gspread_client()
+    store, tenant = get_tenant_store(), current_tenant()
+    handles = store.get(tenant, 'planilha')
+    if handles is None or handles[0] is not gc:
+        if tenant: sh = _gspread_call('open_by_key', gc.open_by_key, tenant)
+        else: sh = _gspread_call('open', gc.open, PLANILHA_TITULO)
+        handles = store.put(tenant, 'planilha', (gc, sh, {}))
+    return handles
+
+def get_spreadsheet():
+    return _spreadsheet_handles()[1]
+
+def _worksheet_pool():
+    return _spreadsheet_handles()[2]
+
+def get_worksheet(sheet_name):
+    pool = _worksheet_pool()
+    if sheet_name not in pool:
+        pool[sheet_name] = _gspread_call('worksheet', get_spreadsheet().worksheet, sheet_name)
+    return pool[sheet_name]
+
+# Cache por aba com contador de versão. Escritas bem-sucedidas atualizam a cópia local
+# (write-through), então só a aba alterada muda de versão e nada é recarregado à toa.
+# A cada SHEET_SYNC_INTERVAL a cópia é sincronizada pelo registro de alterações (só o
+# que mudou). Linhas incluídas ou apagadas à mão na planilha aparecem na sincronização,
+# que confere onde a aba termina; uma célula editada à mão no lugar, só no TTL.
+SHEET_CACHE_TTL = 30 * 60
+SHEET_SYNC_INTERVAL = 30
+
+class SheetCache:
+    def __init__(self, ttl=SHEET_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.versions = {}
+        self.load_ids = itertools.count(1)
+
+    def get(self, sheet_name):
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            if entry is None or time.monotonic() - entry['loaded_at'] > self.ttl:
+                return None
+            return entry['df']
+
+    def version(self, sheet_name):
+        with self.lock:
+            return self.versions.get(sheet_name, 0)
+
+    # Revisão da planilha (aba 'controle') em que a cópia local se baseia
+    def revision(self, sheet_name):
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            return entry['revision'] if entry else None
+
+    # Linhagem: (id da carga, [(job, mutação), ...] aplicados desde a carga). Quem deriva
+    # dados da aba usa isso para se atualizar aplicando só as mutações novas.
+    def lineage(self, sheet_name):
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            return (entry['load_id'], list(entry['applied'])) if entry else (None, [])
+
+    def entry(self, sheet_name):
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            return dict(entry) if entry else None
+
+    # Linha do registro de alterações até onde esta cópia já foi conferida
+    def log_row(self, sheet_name):
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            return entry['log_row'] if entry else 1
+
+    def needs_sync(self, sheet_name):
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            return entry is not None and time.monotonic() - entry['synced_at'] > SHEET_SYNC_INTERVAL
+
+    def mark_synced(self, sheet_name, log_row):
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            if entry is not None:
+                entry.update(log_row=max(entry['log_row'], log_row), synced_at=time.monotonic())
+
+    # Última linha que a aba deve ter, com o cabeçalho, e se a sincronização anterior já
+    # a encontrou em outro lugar
+    def last_row(self, sheet_name):
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            return entry['rows'] if entry else None
+
+    # Devolve True na segunda sincronização seguida com a aba terminando fora do lugar
+    def flag_rows(self, sheet_name, moved):
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            if entry is None: return False
+            repeated = moved and entry['moved']
+            entry['moved'] = moved
+            return repeated
+
+    # age: há quantos segundos a cópia foi lida da planilha (ex.: vinda de um snapshot em disco)
+    # rows: linhas lidas, com o cabeçalho e as em branco (sem a leitura, as do DataFrame)
+    def put(self, sheet_name, df, revision=None, log_row=1, age=0.0, rows=None):
+        with self.lock:
+            now = time.monotonic() - age
+            self.versions[sheet_name] = self.versions.get(sheet_name, 0) + 1
+            self.entries[sheet_name] = {
+                'df': df, 'revision': revision, 'loaded_at': now, 'synced_at': now, 'log_row': log_row,
+                'load_id': next(self.load_ids), 'applied': [], 'nbytes': None,
+                'rows': len(df) + 1 if rows is None else rows, 'moved': False,
+            }
+
+    def invalidate(self, sheet_name=None):
+        with self.lock:
+            for name in ([sheet_name] if sheet_name else list(self.entries)):
+                if self.entries.pop(name, None) is not None:
+                    self.versions[name] = self.versions.get(name, 0) + 1
+
+    def commit(self, sheet_name, mutations, revision, stale, jobs=()):
+        if stale:
+            # Outras escritas entraram no meio: a cópia local não as contém, recarregar
+            self.invalidate(sheet_name)
+        else:
+            self.apply(sheet_name, mutations, revision, jobs)
+
+    def apply(self, sheet_name, mutations, revision=None, jobs=()):
+        with self.lock:
+            entry = self.entries.get(sheet_name)
+            if entry is None: return
+            # Os DataFrames em cache são compartilhados: nunca alterar no lugar, sempre substituir
+            df = apply_mutations(entry['df'], sheet_name, mutations) if mutations else entry['df']
+            self.versions[sheet_name] = self.versions.get(sheet_name, 0) + 1
+            self.entries[sheet_name] = dict(
+                entry, df=df, applied=entry['applied'] + list(jobs), nbytes=None,
+                revision=entry['revision'] if revision is None else revision,
+                rows=entry['rows'] + len(df) - len(entry['df']), moved=False,
+            )
+
+    # Tamanho medido uma vez por versão da aba (o memory_usage profundo custa)
+    def nbytes(self):
+        with self.lock:
+            entries = list(self.entries.values())
+        for entry in entries:
+            if entry['nbytes'] is None: entry['nbytes'] = estimate_nbytes(entry['df'])
+        return sum(entry['nbytes'] for entry in entries)
+
+    def release(self):
+        self.invalidate()
+
+def get_sheet_cache():
+    return tenant_resource('planilhas', SheetCache)
+
+def apply_mutations(df, sheet_name, mutations):
+    id_col = get_id_col(sheet_name)
+    df = df.copy()
+    # Inserts seguidos entram num único concat (importação em lote = milhares de linhas)
+    fresh, fresh_ids = [], set()
+    for op, id_value, data in mutations:
+        if fresh and (op != 'insert' or int(id_value) in fresh_ids):
+            df = concat_typed([df, coerce_frame(sheet_name, pd.DataFrame(fresh))])
+            fresh, fresh_ids = [], set()
+        mask = (df[id_col] == int(id_value)).to_numpy()
+        # Um insert cujo id já está presente (gravação recém-confirmada) vira update
+        if op == 'insert' and not mask.any():
+            fresh.append(data)
+            fresh_ids.add(int(id_value))
+        elif op in ('insert', 'update'):
+            for k, v in data.items():
+                v = coerce_value(sheet_name, k, v)
+                if k not in df.columns: df[k] = None
+                if isinstance(df[k].dtype, pd.CategoricalDtype) and v not in df[k].cat.categories:
+                    df[k] = df[k].cat.add_categories([v])
+                df.loc[mask, k] = v
+        elif op == 'delete':
+            df = df[~mask]
+    if fresh:
+        df = concat_typed([df, coerce_frame(sheet_name, pd.DataFrame(fresh))])
+    return df.reset_index(drop=True)
+
 def get_sheet_data(sheet_name, force_refresh=False):
+    return get_sheets_data((sheet_name,), force_refresh)[sheet_name]
+
+# Veículos, prestadores e serviços numa única chamada à API, em vez de três leituras em série
+def get_all_sheet_data(force_refresh=False):
+    data = get_sheets_data(tuple(EXPECTED_COLS), force_refresh)
+    return tuple(data[name] for name in EXPECTED_COLS)
+
+def get_sheets_data(sheet_names, force_refresh=False):
+    return {name: df for name, (df, _) in get_sheets_snapshot(sheet_names, force_refresh).items()}
+
+# Devolve {aba: (df, linhagem)}, já com as gravações pendentes da fila aplicadas
+def get_sheets_snapshot(sheet_names, force_refresh=False):
+    cache = get_sheet_cache()
+    write_queue = get_write_queue()
     if force_refresh:
-        st.cache_data.clear()
-    return _read_data_cached(sheet_name)
+        for name in sheet_names: cache.invalidate(name)
+    replica = get_local_replica()
+    warmup = get_warmup()
+    if warmup.warming():
+        # Durante o aquecimento: serve o snapshot; sem ele, espera a carga que já está em curso
+        warmup.loaded.wait()
+        if any(cache.get(name) is None for name in sheet_names): warmup.done.wait()
+    # Com a réplica local (ou o aquecimento em curso), quem sincroniza é a thread dela;
+    # a leitura nunca espera a rede
+    due = [name for name in sheet_names if cache.needs_sync(name)] if replica is None and not warmup.warming() else []
+    if due:
+        try:
+            _sync_sheets(due)
+        except Exception:
+            # Sem sincronizar, serve a cópia que já tem; tenta de novo na próxima leitura
+            pass
+    # Cópia local e fila lidas juntas, para uma gravação concluída não sumir nem aparecer duas vezes
+    with write_queue.lock:
+        data = {name: cache.get(name) for name in sheet_names}
+        lineage = {name: cache.lineage(name) for name in sheet_names}
+        pending = {name: write_queue.pending_jobs(name) for name in sheet_names}
+    missing = tuple(name for name, df in data.items() if df is None)
+    metrics = get_metrics()
+    for name in sheet_names: metrics.cache('planilhas', 'miss' if name in missing else 'hit')
+    if missing:
+        loaded = {}
+        if replica is not None:
+            loaded = replica.load(missing)
+            for name in missing: metrics.cache('replica', 'hit' if name in loaded else 'miss')
+        rest = tuple(name for name in missing if name not in loaded)
+        if rest: loaded.update(_read_sheets(rest))
+        for name in missing:
+            data[name], revision, log_row, rows = loaded[name]
+            cache.put(name, data[name], revision, log_row, rows=rows)
+            lineage[name] = cache.lineage(name)
+        get_tenant_store().trim(keep=current_tenant())
+    snapshot = {}
+    for name in sheet_names:
+        jobs = pending[name]
+        # Gravações ainda na fila já aparecem na cópia local
+        df = apply_mutations(data[name], name, [m for _, m in jobs]) if jobs else data[name]
+        snapshot[name] = (df, (lineage[name][0], lineage[name][1] + jobs))
+    return snapshot
+
+# Põe a cópia em memória em dia: sincroniza pelo registro de alterações as abas que já
+# estão carregadas; a que saiu da memória (TTL, conflito) volta pela leitura completa
+def refresh_cache(sheet_names):
+    cache = get_sheet_cache()
+    cached = [name for name in sheet_names if cache.get(name) is not None]
+    if cached: _sync_sheets(cached)
+    missing = tuple(name for name in sheet_names if cache.get(name) is None)
+    if missing:
+        for name, (df, revision, log_row, rows) in _read_sheets(missing).items():
+            cache.put(name, df, revision, log_row, rows=rows)
+        get_tenant_store().trim(keep=current_tenant())
+
+def _values_to_frame(sheet_name, values):
+    if not values or not values[0]:
+        return empty_frame(sheet_name)
+    header, width = values[0], len(values[0])
+    rows = [(list(r) + [""] * width)[:width] for r in values[1:] if any(r)]
+    return coerce_frame(sheet_name, pd.DataFrame(rows, columns=header, dtype=object))
+
+# A aba 'controle' e o tamanho do registro de alterações vêm na mesma leitura, para
+# saber em que revisão está cada aba carregada e de onde continuar a sincronização
+def _fetch_sheet_values(sheet_names):
+    names = (CONTROL_SHEET,) + tuple(sheet_names)
+    try:
+        get_control_worksheet()
+        get_changelog_worksheet()
+        ranges = [f"'{name}'" for name in names] + [f"'{CHANGELOG_SHEET}'!A:A"]
+        resp = _gspread_call('values_batch_get', get_spreadsheet().values_batch_get, ranges)
+        values = [vr.get('values', []) for vr in resp['valueRanges']]
+    except Exception as e:
+        # Sem cota não adianta multiplicar as leituras
+        if _status_code(e) == 429: raise
+        # Alternativa: uma leitura por aba, em paralelo, reaproveitando os handles abertos
+        handles = [get_control_worksheet()] + [get_worksheet(name) for name in sheet_names]
+        with ThreadPoolExecutor(max_workers=len(handles) + 1) as pool:
+            log = pool.submit(in_tenant(lambda: _gspread_call('col_values', get_changelog_worksheet().col_values, 1)))
+            values = list(pool.map(lambda ws: _gspread_call('get_all_values', ws.get_all_values), handles)) + [log.result()]
+    return values[0], values[1:-1], max(len(values[-1]), 1)
+
+def _read_sheets(sheet_names):
+    # As repetições ficam no _gspread_call; aqui a falha vira SheetReadError
+    try:
+        control_values, values, log_row = _fetch_sheet_values(sheet_names)
+        control = _parse_control(control_values)
+    except Exception as e:
+        raise SheetReadError(f"Não foi possível ler a planilha ({', '.join(sheet_names)}): {e}") from e
+    return {
+        name: (_values_to_frame(name, v), control.get(name, {}).get('revisao', 0), log_row, len(v))
+        for name, v in zip(sheet_names, values)
+    }
+
+# Sincronização incremental: uma leitura traz o 'controle' e só as linhas novas do
+# registro de alterações; as mutações de cada revisão que falta são aplicadas na cópia
+# local. Se alguma revisão não estiver inteira no registro (registro limpo, compactação,
+# escrita interrompida), a aba é descartada e recarregada por completo.
+def _sync_sheets(sheet_names):
+    cache = get_sheet_cache()
+    metrics = get_metrics()
+    start = min(cache.log_row(name) for name in sheet_names)
+    # Na mesma leitura, a última linha de cada aba e a seguinte: basta para ver linhas
+    # incluídas ou apagadas à mão, sem baixar a aba
+    last = {name: cache.last_row(name) for name in sheet_names if cache.last_row(name)}
+    ranges = [f"'{CONTROL_SHEET}'", f"'{CHANGELOG_SHEET}'!A{start + 1}:F"] + [f"'{name}'!{n}:{n + 1}" for name, n in last.items()]
+    resp = _gspread_call('values_batch_get', get_spreadsheet().values_batch_get, ranges)
+    control_values, entries, *tails = [vr.get('values', []) for vr in resp['valueRanges']]
+    tails = dict(zip(last, tails))
+    control = _parse_control(control_values)
+    entries = [(list(e) + [""] * len(CHANGELOG_COLS))[:len(CHANGELOG_COLS)] for e in entries]
+
+    # Só avança até a última linha cuja revisão o 'controle' já confirma (registro e
+    # revisão sobem juntos; um registro à frente da revisão veio de fora da vez)
+    confirmed = 0
+    for e in entries:
+        if _control_int(e[1]) > control.get(e[0], {}).get('revisao', 0): break
+        confirmed += 1
+    cursor = start + confirmed
+
+    for name in sheet_names:
+        base, remote = cache.revision(name), control.get(name, {}).get('revisao', 0)
+        if base is None: continue
+        groups = collections.defaultdict(list)
+        for e in entries[:confirmed]:
+            if e[0] == name: groups[_control_int(e[1])].append(e)
+        # Uma revisão com mais linhas do que anunciou foi registrada por dois escritores
+        # (um perdeu a vez no meio da gravação): mesmo com remote == base a cópia pode
+        # não ter as alterações do outro
+        duplicated = any(len(g) != _control_int(g[0][5]) or len({e[5] for e in g}) > 1 for g in groups.values())
+        if remote == base and not duplicated:
+            # A aba não termina onde a cópia diz, sem revisão nova: edição feita à mão. Pode
+            # ser também uma escrita que ainda não fechou a vez, por isso só na segunda vez
+            tail = tails.get(name)
+            moved = tail is not None and not (len(tail) == 1 and any(tail[0]))
+            if cache.flag_rows(name, moved):
+                metrics.cache('sincronizacao', 'miss')
+                cache.invalidate(name)
+                continue
+            cache.mark_synced(name, cursor)
+            continue
+        by_revision = {rev: g for rev, g in groups.items() if base < rev <= remote}
+        complete = not duplicated and remote > base and all(
+            rev in by_revision and len(by_revision[rev]) == _control_int(by_revision[rev][0][5])
+            and all(e[2] in ('insert', 'update', 'delete') for e in by_revision[rev])
+            for rev in range(base + 1, remote + 1)
+        )
+        if not complete:
+            metrics.cache('sincronizacao', 'miss')
+            cache.invalidate(name)
+            continue
+        mutations = [(e[2], _control_int(e[3]), json.loads(e[4]) if e[4] else None)
+                     for rev in range(base + 1, remote + 1) for e in by_revision[rev]]
+        jobs = [(f'sync-{name}-{base}-{i}', m) for i, m in enumerate(mutations)]
+        cache.apply(name, mutations, remote, jobs)
+        cache.mark_synced(name, cursor)
+        metrics.cache('sincronizacao', 'hit')
+
+def get_id_col(sheet_name):
+    return f'id_{sheet_name}'
+
+def to_sheet_value(value):
+    if value is None or value is pd.NA: return ""
+    if isinstance(value, (pd.Timestamp, date)):
+        return "" if pd.isna(value) else value.strftime('%Y-%m-%d')
+    if isinstance(value, np.generic): value = value.item()
+    if isinstance(value, float):
+        if np.isnan(value): return ""
+        if np.isinf(value): return 0
+    return value
 
-@st.cache_data(ttl=10)
-def _read_data_cached(sheet_name):
-    for i in range(3):
+def _row_index(id_values):
+    # Mapeia id -> número da linha na planilha (linha 1 é o cabeçalho); a coluna é
+    # convertida de uma vez, célula a célula custava mais de 1 s a 100k linhas
+    flat = [(raw[0] if raw else "") if isinstance(raw, list) else raw for raw in id_values[1:]]
+    ids = pd.to_numeric(pd.Series(flat, dtype=object), errors='coerce').to_numpy(dtype='float64')
+    valid = np.flatnonzero(~np.isnan(ids))
+    return dict(zip(ids[valid].astype('int64').tolist(), (valid + 2).tolist()))
+
+def _same_value(a, b):
+    return str(to_sheet_value(a)) == str(to_sheet_value(b))
+
+# ------------------------------------------------------------------------------
+# Controle de concorrência: a aba 'controle' guarda, por aba de dados, o próximo id
+# livre e um número de revisão incrementado a cada escrita.
+# ------------------------------------------------------------------------------
+
+CONTROL_SHEET = 'controle'
+CONTROL_COLS = ['planilha', 'proximo_id', 'revisao']
+ID_BLOCK_SIZE = 10
+
+class ConflictError(Exception):
+    pass
+
+def _get_or_create_worksheet(title, cols, rows=()):
+    pool = _worksheet_pool()
+    if title not in pool:
+        sh = get_spreadsheet()
         try:
-            gc = get_gspread_client()
-            sh = gc.open_by_key(SHEET_ID) if SHEET_ID else gc.open(PLANILHA_TITULO)
-            worksheet = sh.worksheet(sheet_name)
-            data = worksheet.get_all_records()
-            df = pd.DataFrame(data)
-            
-            if df.empty:
-                return pd.DataFrame(columns=EXPECTED_COLS.get(sheet_name, []))
+            ws = _gspread_call('worksheet', sh.worksheet, title)
+        except gspread.WorksheetNotFound:
+            # Aba e conteúdo inicial numa chamada só: ninguém chega a ver a aba ainda sem
+            # cabeçalho, nem a acrescentar linhas que o cabeçalho depois sobrescreveria
+            sheet_id = random.randrange(1, 2 ** 31)
+            properties = {'sheetId': sheet_id, 'title': title, 'gridProperties': {'rowCount': len(rows) + 10, 'columnCount': len(cols)}}
+            start = {'sheetId': sheet_id, 'rowIndex': 0, 'columnIndex': 0}
+            try:
+                _gspread_call('spreadsheet_batch_update', sh.batch_update, {'requests': [
+                    {'addSheet': {'properties': properties}},
+                    {'updateCells': {'start': start, 'rows': _rows_data([cols] + list(rows)), 'fields': 'userEnteredValue'}},
+                ]})
+            except gspread.exceptions.APIError:
+                # Outro processo criou a aba no meio tempo: usa a dele
+                pass
+            ws = _gspread_call('worksheet', sh.worksheet, title)
+        pool[title] = ws
+    return pool[title]
+
+def get_control_worksheet():
+    # Já nasce com uma linha por aba de dados
+    return _get_or_create_worksheet(CONTROL_SHEET, CONTROL_COLS, [[name, 0, 0] for name in EXPECTED_COLS])
 
-            id_col = f'id_{sheet_name}' if sheet_name in ('veiculo', 'prestador') else 'id_servico'
-            if id_col in df.columns:
-                df[id_col] = pd.to_numeric(df[id_col], errors='coerce').fillna(0).astype(int)
-            return df
+# Registro de alterações: cada escrita acrescenta uma linha por mutação com a revisão
+# que ela gerou, os valores gravados e quantas linhas a revisão tem no total
+CHANGELOG_SHEET = 'alteracoes'
+CHANGELOG_COLS = ['planilha', 'revisao', 'operacao', 'id', 'dados', 'linhas']
+
+def get_changelog_worksheet():
+    return _get_or_create_worksheet(CHANGELOG_SHEET, CHANGELOG_COLS)
+
+def _dump_data(data):
+    return json.dumps({k: to_sheet_value(v) for k, v in data.items()}, ensure_ascii=False) if data else ""
+
+def _log_rows(sheet_name, revision, mutations):
+    return [[sheet_name, revision, op, id_value, _dump_data(data), len(mutations)]
+            for op, id_value, data in mutations]
+
+def _control_int(value):
+    # Célula vazia vira NaN, e NaN é "verdadeiro": "or 0" não bastava
+    value = pd.to_numeric(value, errors='coerce')
+    return 0 if pd.isna(value) else int(value)
+
+def _parse_control(values):
+    control = {}
+    for row_number, row in enumerate(values[1:], start=2):
+        row = (list(row) + [""] * len(CONTROL_COLS))[:len(CONTROL_COLS)]
+        if not row[0]: continue
+        control[row[0]] = {'row': row_number, 'proximo_id': _control_int(row[1]), 'revisao': _control_int(row[2])}
+    return control
+
+# ------------------------------------------------------------------------------
+# Vez de gravar: a planilha não tem compare-and-set, mas a API acrescenta linhas numa
+# ordem única. Quem vai gravar numa aba acrescenta uma senha em 'senhas' e espera as
+# senhas anteriores da mesma aba terminarem: a ordem vem do servidor, não do relógio
+# nem da latência. A validade (TICKET_TTL) só destrava a fila quando um processo morre
+# segurando a vez; por isso quem tem a vez só começa a gravar até a metade dela.
+# ------------------------------------------------------------------------------
+
+TICKET_SHEET = 'senhas'
+TICKET_COLS = ['planilha', 'senha', 'momento', 'estado']
+TICKET_TTL = 60
+TICKET_WAIT = 90
+TICKET_POLL = 0.5
+# Senhas mais velhas que TICKET_TTL não contam, e 200 linhas passam de longe o que a
+# cota de escrita da API deixa acrescentar nesse intervalo
+TICKET_LOOKBACK = 200
+
+Turn = collections.namedtuple('Turn', ['sheet', 'token', 'entry', 'values', 'deadline'])
+
+def get_ticket_worksheet():
+    return _get_or_create_worksheet(TICKET_SHEET, TICKET_COLS)
+
+def _ticket_row(sheet_name, token, state):
+    return [sheet_name, token, str(int(time.time())), state]
+
+def _appended_row(resp):
+    first = resp['updates']['updatedRange'].split('!')[-1].split(':')[0]
+    return gspread.utils.a1_to_rowcol(first)[0]
+
+# Senhas da aba pedidas antes da nossa, ainda sem 'fim' e dentro da validade; None se a
+# nossa não está entre as linhas lidas
+def _tickets_ahead(rows, sheet_name, token):
+    rows = [(list(r) + [""] * len(TICKET_COLS))[:len(TICKET_COLS)] for r in rows]
+    done = {r[1] for r in rows if r[3] == 'fim'}
+    now = time.time()
+    ahead = set()
+    for r in rows:
+        if r[1] == token and r[3] == 'pede': return ahead
+        if r[0] == sheet_name and r[3] == 'pede' and r[1] not in done and now - _control_int(r[2]) < TICKET_TTL:
+            ahead.add(r[1])
+    return None
+
+# Pega a vez da aba. ranges: o que mais ler na mesma chamada que confirma a vez (chega
+# em Turn.values, já valendo para a vez)
+def acquire_turn(sheet_name, ranges=()):
+    get_control_worksheet()
+    ws = get_ticket_worksheet()
+    give_up = time.monotonic() + TICKET_WAIT
+    while True:
+        t0 = time.monotonic()
+        token = uuid.uuid4().hex
+        resp = _gspread_call('append_rows', ws.append_rows, [_ticket_row(sheet_name, token, 'pede')],
+                             value_input_option='RAW', table_range='A1')
+        try:
+            first = max(2, _appended_row(resp) - TICKET_LOOKBACK)
+            while True:
+                read = [f"'{TICKET_SHEET}'!A{first}:D", f"'{CONTROL_SHEET}'"] + list(ranges)
+                resp = _gspread_call('values_batch_get', get_spreadsheet().values_batch_get, read)
+                tickets, control, *values = [vr.get('values', []) for vr in resp['valueRanges']]
+                ahead = _tickets_ahead(tickets, sheet_name, token)
+                if ahead is None:
+                    # Senhas antigas foram apagadas (compactação) e as linhas subiram
+                    if first == 2: raise ConflictError(f"A senha de gravação em '{sheet_name}' sumiu.")
+                    first = 2
+                    continue
+                # Senha que esperou demais volta para o fim da fila: os outros já podem
+                # estar perto de considerá-la vencida
+                if time.monotonic() - t0 > TICKET_TTL / 4: break
+                if not ahead:
+                    entry = _parse_control(control).get(sheet_name) or {'row': None, 'proximo_id': 0, 'revisao': 0}
+                    return Turn(sheet_name, token, entry, values, t0 + TICKET_TTL / 2)
+                time.sleep(random.uniform(0.5, 1.0) * TICKET_POLL)
+        except BaseException:
+            abandon_turn(sheet_name, token)
+            raise
+        abandon_turn(sheet_name, token)
+        if time.monotonic() > give_up:
+            raise ConflictError("Não foi possível obter a vez de gravar: muitas gravações simultâneas.")
+
+# Antes da primeira gravação: passada a metade da validade da senha (margem para
+# relógios diferentes), outro processo pode já tê-la descartado
+def check_turn(turn):
+    if time.monotonic() > turn.deadline:
+        raise ConflictError(f"A gravação em '{turn.sheet}' esperou demais e perdeu a vez. Tente novamente.")
+
+def _cell_data(value):
+    value = to_sheet_value(value)
+    if isinstance(value, bool): return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, (int, float)): return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+def _rows_data(rows):
+    return [{'values': [_cell_data(v) for v in row]} for row in rows]
+
+# Fecha a vez numa chamada só, e atômica: registro de alterações, contador de ids e
+# revisão no 'controle' e o 'fim' da senha entram todos juntos ou nenhum entra
+def finish_turn(turn, revision=None, next_id=None, log=()):
+    body = []
+    if log:
+        body.append({'appendCells': {'sheetId': get_changelog_worksheet().id, 'rows': _rows_data(log), 'fields': 'userEnteredValue'}})
+    if revision is not None or next_id is not None:
+        control = get_control_worksheet()
+        values = [turn.entry['proximo_id'] if next_id is None else next_id,
+                  turn.entry['revisao'] if revision is None else revision]
+        if turn.entry['row']:
+            start = {'sheetId': control.id, 'rowIndex': turn.entry['row'] - 1, 'columnIndex': 1}
+            body.append({'updateCells': {'start': start, 'rows': _rows_data([values]), 'fields': 'userEnteredValue'}})
+        else:
+            body.append({'appendCells': {'sheetId': control.id, 'rows': _rows_data([[turn.sheet] + values]), 'fields': 'userEnteredValue'}})
+    body.append({'appendCells': {'sheetId': get_ticket_worksheet().id, 'rows': _rows_data([_ticket_row(turn.sheet, turn.token, 'fim')]), 'fields': 'userEnteredValue'}})
+    _gspread_call('spreadsheet_batch_update', get_spreadsheet().batch_update, {'requests': body})
+
+# Saída sem gravar nada (ou depois de um erro): só devolve a vez
+def abandon_turn(sheet_name, token):
+    try:
+        _gspread_call('append_rows', get_ticket_worksheet().append_rows, [_ticket_row(sheet_name, token, 'fim')],
+                      value_input_option='RAW', table_range='A1')
+    except Exception:
+        # Sem o 'fim', a senha vence sozinha em TICKET_TTL
+        pass
+
+# Na compactação: senhas de mais de um dia já não servem a ninguém (a vez é achada pela
+# senha, não pela linha, então apagar as de cima não atrapalha quem está na fila)
+def _trim_tickets():
+    ws = get_ticket_worksheet()
+    moments = _gspread_call('col_values', ws.col_values, 3)[1:]
+    old = next((i for i, m in enumerate(moments) if time.time() - _control_int(m) < 24 * 3600), len(moments))
+    if old:
+        _gspread_call('spreadsheet_batch_update', ws.spreadsheet.batch_update, {'requests': [
+            {'deleteDimension': {'range': {'sheetId': ws.id, 'dimension': 'ROWS', 'startIndex': 1, 'endIndex': old + 1}}}
+        ]})
+
+def reserve_id_block(sheet_name, count):
+    # Reserva [inicio, fim) no contador da aba 'controle', na vez da aba
+    turn = acquire_turn(sheet_name)
+    try:
+        start = max(turn.entry['proximo_id'], 1)
+        # Nunca abaixo do maior id já existente (ex.: linhas incluídas à mão na planilha)
+        df = get_sheet_data(sheet_name)
+        id_col = get_id_col(sheet_name)
+        if not df.empty and id_col in df.columns:
+            start = max(start, int(df[id_col].max()) + 1)
+        check_turn(turn)
+        finish_turn(turn, next_id=start + count)
+    except Exception:
+        abandon_turn(sheet_name, turn.token)
+        raise
+    return start, start + count
+
+# Ids vêm de blocos reservados no 'controle'. Um bloco de reserva por aba é pedido em
+# segundo plano antes de fazer falta (ao abrir o formulário, ou quando o atual começa a
+# ser usado), para a inclusão não esperar pela vez de gravar na tela
+class IdAllocator:
+    def __init__(self, block_size=ID_BLOCK_SIZE):
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.blocks = {}
+        self.spare = {}
+        self.refills = {}
+
+    def next_id(self, sheet_name):
+        return self.reserve(sheet_name, 1)[0]
+
+    def prefetch(self, sheet_name):
+        with self.lock:
+            if sheet_name in self.spare or sheet_name in self.refills: return
+            thread = threading.Thread(target=in_tenant(self._refill), args=(sheet_name,), name=f'ids-{sheet_name}', daemon=True)
+            self.refills[sheet_name] = thread
+        thread.start()
+
+    def _refill(self, sheet_name):
+        try:
+            block = reserve_id_block(sheet_name, self.block_size)
         except Exception:
-            time.sleep(0.5)
-    return pd.DataFrame(columns=EXPECTED_COLS.get(sheet_name, []))
+            # Sem reserva, a próxima inclusão pede o bloco ela mesma
+            block = None
+        with self.lock:
+            if block: self.spare[sheet_name] = block
+            del self.refills[sheet_name]
+
+    def reserve(self, sheet_name, count):
+        while True:
+            with self.lock:
+                nxt, end = self.blocks.get(sheet_name, (0, 0))
+                refill = None
+                if end - nxt < count:
+                    spare = self.spare.get(sheet_name)
+                    if spare and spare[1] - spare[0] >= count:
+                        nxt, end = self.spare.pop(sheet_name)
+                    elif count <= self.block_size and sheet_name in self.refills:
+                        refill = self.refills[sheet_name]
+                    else:
+                        nxt, end = reserve_id_block(sheet_name, max(count, self.block_size))
+                if refill is None:
+                    self.blocks[sheet_name] = (nxt + count, end)
+                    break
+            # O bloco de reserva já está a caminho: espera por ele em vez de pedir outro
+            refill.join()
+        self.prefetch(sheet_name)
+        return list(range(nxt, nxt + count))
+
+def get_id_allocator():
+    return tenant_resource('ids', IdAllocator)
+
+def _check_conflicts(sheet_name, header, changes, row_of, current_rows):
+    # A revisão da aba mudou desde a nossa leitura: só segue se as linhas que vamos
+    # alterar continuam iguais à cópia em que a edição se baseou
+    base = get_sheet_cache().get(sheet_name)
+    id_col = get_id_col(sheet_name)
+    for op, id_value, data in changes:
+        if int(id_value) not in row_of:
+            raise ConflictError(f"O registro {id_value} foi excluído por outro usuário.")
+        if base is None: continue
+        base_row = base[base[id_col] == int(id_value)]
+        if base_row.empty: continue
+        base_row = base_row.iloc[0]
+        now = coerce_frame(sheet_name, pd.DataFrame([dict(zip(header, current_rows[int(id_value)]))], dtype=object)).iloc[0]
+        if any(not _same_value(now[k], base_row[k]) for k in base_row.index if k in header):
+            raise ConflictError(f"O registro {id_value} foi alterado por outro usuário. Recarregue os dados e tente novamente.")
 
-def write_sheet_data(sheet_name, df_new):
+# Escrita incremental: cada mutação é (operacao, id, dados).
+# insert -> append, update -> só as células alteradas, delete -> remoção da linha pelo índice id -> linha.
+# Devolve (revisao, defasada); quem chama decide como refletir a escrita no cache.
+def write_sheet_delta(sheet_name, mutations):
+    cache = get_sheet_cache()
+    id_col = get_id_col(sheet_name)
     try:
-        gc = get_gspread_client()
-        sh = gc.open_by_key(SHEET_ID) if SHEET_ID else gc.open(PLANILHA_TITULO)
-        worksheet = sh.worksheet(sheet_name)
-        
-        df_save = df_new.copy()
-        for col in df_save.select_dtypes(include=['datetime64']).columns:
-            df_save[col] = df_save[col].dt.strftime('%Y-%m-%d')
-            
-        df_save = df_save.fillna("") 
-        df_save = df_save.replace([np.inf, -np.inf], 0)
-        
-        worksheet.clear()
-        worksheet.update('A1', [df_save.columns.tolist()] + df_save.values.tolist(), value_input_option='USER_ENTERED')
-        
-        st.cache_data.clear()
+        worksheet = get_worksheet(sheet_name)
+        # Cabeçalho e coluna de ids vêm na leitura que confirma a vez: até o fim dela
+        # ninguém mais grava na aba, e a revisão e o mapa id -> linha continuam valendo
+        turn = acquire_turn(sheet_name, [f"'{sheet_name}'!1:1", f"'{sheet_name}'!A:A"])
+    except ConflictError:
+        cache.invalidate(sheet_name)
+        raise
+    revision = turn.entry['revisao']
+    writing = False
+    try:
+        header_values, id_values = turn.values
+        current_header = header_values[0] if header_values else []
+        header = list(current_header) or list(EXPECTED_COLS.get(sheet_name, []))
+        new_cols = [k for _, _, data in mutations if data for k in data if k not in header]
+        new_header = bool(new_cols or not current_header)
+        header += list(dict.fromkeys(new_cols))
+
+        if header.index(id_col) != 0:
+            id_values = _gspread_call('col_values', worksheet.col_values, header.index(id_col) + 1)
+
+        inserts = [data for op, _, data in mutations if op == 'insert']
+        changes = [(op, id_value, data) for op, id_value, data in mutations if op in ('update', 'delete')]
+        row_of = _row_index(id_values) if changes else {}
+
+        stale = revision != cache.revision(sheet_name)
+        if stale and changes:
+            targets = [int(id_value) for _, id_value, _ in changes if int(id_value) in row_of]
+            rows = _gspread_call('batch_get', worksheet.batch_get, [f"A{row_of[t]}:{gspread.utils.rowcol_to_a1(row_of[t], len(header))}" for t in targets]) if targets else []
+            current_rows = {t: (list(r[0]) if r else []) + [""] * len(header) for t, r in zip(targets, rows)}
+            _check_conflicts(sheet_name, header, changes, row_of, current_rows)
+
+        cells = []
+        rows_to_delete = set()
+        for op, id_value, data in changes:
+            row_number = row_of.get(int(id_value))
+            if row_number is None: continue
+            if op == 'update':
+                for k, v in data.items():
+                    a1 = gspread.utils.rowcol_to_a1(row_number, header.index(k) + 1)
+                    cells.append({'range': a1, 'values': [[to_sheet_value(v)]]})
+            else:
+                rows_to_delete.add(row_number)
+
+        # Daqui em diante a aba muda: a vez é conferida antes da primeira gravação
+        check_turn(turn)
+        writing = True
+
+        if new_header:
+            _gspread_call('update', worksheet.update, [header], 'A1', value_input_option='USER_ENTERED')
+
+        if cells:
+            _gspread_call('batch_update', worksheet.batch_update, cells, value_input_option='USER_ENTERED')
+
+        if rows_to_delete:
+            # De baixo para cima, para que os índices das linhas restantes não mudem
+            _gspread_call('spreadsheet_batch_update', worksheet.spreadsheet.batch_update, {'requests': [
+                {'deleteDimension': {'range': {'sheetId': worksheet.id, 'dimension': 'ROWS', 'startIndex': r - 1, 'endIndex': r}}}
+                for r in sorted(rows_to_delete, reverse=True)
+            ]})
+
+        if inserts:
+            rows = [[to_sheet_value(data.get(c, "")) for c in header] for data in inserts]
+            _gspread_call('append_rows', worksheet.append_rows, rows, value_input_option='USER_ENTERED', table_range='A1')
+    except Exception as e:
+        if writing:
+            # Parte da escrita pode ter chegado à aba: a revisão sobe mesmo sem registro,
+            # e quem sincronizar recarrega a aba em vez de perder a alteração
+            try:
+                finish_turn(turn, revision=revision + 1)
+            except Exception:
+                abandon_turn(sheet_name, turn.token)
+        else:
+            abandon_turn(sheet_name, turn.token)
+        if writing or isinstance(e, ConflictError): cache.invalidate(sheet_name)
+        raise
+
+    # A alteração já está na planilha: uma falha daqui em diante não a desfaz, então
+    # a escrita não pode ser dada como falha (repetir duplicaria um insert)
+    try:
+        finish_turn(turn, revision=revision + 1, log=_log_rows(sheet_name, revision + 1, mutations))
+    except Exception:
+        abandon_turn(sheet_name, turn.token)
+        get_metrics().record('gravacao', 'registro', 0.0, ok=False)
+        return revision + 1, True
+    return revision + 1, stale
+
+# Reescrita completa da aba: usada apenas na compactação explícita. A aba é lida já na
+# vez, para nada gravado entre a leitura e a reescrita se perder
+def compact_sheet_data(sheet_name):
+    try:
+        worksheet = get_worksheet(sheet_name)
+        id_col = get_id_col(sheet_name)
+        turn = acquire_turn(sheet_name, [f"'{sheet_name}'"])
+        try:
+            df = _values_to_frame(sheet_name, turn.values[0])
+            # Id repetido: qual das linhas vale só quem conhece os dados sabe decidir
+            repeated = sorted(set(df[id_col][(df[id_col] > 0) & df[id_col].duplicated()].tolist()))
+            if repeated:
+                raise ConflictError(f"'{sheet_name}' tem ids repetidos ({', '.join(map(str, repeated[:10]))}). "
+                                    "Corrija na planilha e compacte de novo.")
+            # Linha sem id válido (incluída à mão) ganha um id novo, depois dos já reservados
+            missing = (df[id_col] <= 0).to_numpy()
+            next_id = None
+            if missing.any():
+                start = max(turn.entry['proximo_id'], 1, int(df[id_col].max()) + 1)
+                next_id = start + int(missing.sum())
+                df.loc[missing, id_col] = np.arange(start, next_id, dtype='int32')
+            df = df.sort_values(id_col, kind='stable')
+            rows = [[to_sheet_value(v) for v in row] for row in df.itertuples(index=False)]
+            check_turn(turn)
+        except Exception:
+            abandon_turn(sheet_name, turn.token)
+            raise
+        # Quem sincroniza por cima desta revisão precisa recarregar a aba inteira
+        revision = turn.entry['revisao'] + 1
+        try:
+            # Sobrescreve no lugar e só então corta as linhas excedentes: a aba nunca fica vazia
+            _gspread_call('update', worksheet.update, [df.columns.tolist()] + rows, 'A1', value_input_option='USER_ENTERED')
+            _gspread_call('resize', worksheet.resize, rows=len(rows) + 1)
+        finally:
+            # Mesmo interrompida no meio, a reescrita pode ter mudado a aba
+            finish_turn(turn, revision=revision, next_id=next_id, log=_log_rows(sheet_name, revision, [('reset', "", None)]))
+
+        get_sheet_cache().invalidate(sheet_name)
         return True
     except Exception as e:
-        st.error(f"Erro ao salvar: {e}")
+        st.error(f"Erro ao compactar: {e}")
         return False
 
+# ------------------------------------------------------------------------------
+# Fila de gravação (write-behind): a interface enfileira e segue; uma thread
+# agrupa as mutações consecutivas de cada aba numa única escrita.
+# ------------------------------------------------------------------------------
+
+WRITE_BEHIND_LINGER = 0.2
+WRITE_JOB_HISTORY = 500
+
+def coalesce_mutations(mutations):
+    out = []
+    position = {}
+    for op, id_value, data in mutations:
+        key = int(id_value)
+        i = position.get(key)
+        if i is None or out[i][0] == 'delete':
+            position[key] = len(out)
+            out.append([op, id_value, dict(data) if data else data])
+        elif op == 'delete':
+            # Inserir e apagar na mesma leva não precisa chegar à planilha
+            out[i] = None if out[i][0] == 'insert' else [op, id_value, None]
+            if out[i] is None: del position[key]
+        else:
+            out[i][2].update(data)
+    return [tuple(m) for m in out if m]
+
+class WriteBehindQueue:
+    # outbox: réplica local onde os jobs pendentes ficam guardados até chegarem à planilha
+    def __init__(self, outbox=None):
+        self.queue = queue.Queue()
+        self.lock = threading.RLock()
+        self.jobs = collections.OrderedDict()
+        self.pending = {}
+        self.outbox = outbox
+        # Gravações que não chegaram à planilha antes de o processo parar
+        for job_id, sheet_name, mutation in (outbox.pending() if outbox else []):
+            self._enqueue(job_id, sheet_name, mutation)
+        self.worker = threading.Thread(target=in_tenant(self._run), name=f'write-behind-{tenant_slug()}', daemon=True)
+        self.worker.start()
+
+    def submit(self, sheet_name, mutation):
+        job_id = uuid.uuid4().hex
+        if self.outbox: self.outbox.push(job_id, sheet_name, mutation)
+        self._enqueue(job_id, sheet_name, mutation)
+        return job_id
+
+    def _enqueue(self, job_id, sheet_name, mutation):
+        with self.lock:
+            self.jobs[job_id] = {'sheet': sheet_name, 'mutation': mutation, 'status': 'pending', 'error': None}
+            self.pending.setdefault(sheet_name, []).append(job_id)
+        self.queue.put(job_id)
+
+    def pending_jobs(self, sheet_name):
+        with self.lock:
+            return [(j, self.jobs[j]['mutation']) for j in self.pending.get(sheet_name, [])]
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return (job['status'], job['error']) if job else ('committed', None)
+
+    def wait_idle(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not self.queue.unfinished_tasks
+
+    def _run(self):
+        while True:
+            job_ids = [self.queue.get()]
+            time.sleep(WRITE_BEHIND_LINGER)
+            while True:
+                try: job_ids.append(self.queue.get_nowait())
+                except queue.Empty: break
+            for sheet_name, run in itertools.groupby(job_ids, key=lambda j: self.jobs[j]['sheet']):
+                self._commit(sheet_name, list(run))
+            for _ in job_ids: self.queue.task_done()
+
+    def _commit(self, sheet_name, job_ids):
+        mutations = coalesce_mutations([self.jobs[j]['mutation'] for j in job_ids])
+        status, error, result = 'committed', None, None
+        try:
+            if mutations: result = write_sheet_delta(sheet_name, mutations)
+        except Exception as e:
+            if self.outbox and _is_outage(e):
+                # Planilha fora do ar: os jobs continuam pendentes (e na cópia local) até voltar
+                get_metrics().record('gravacao', 'adiada', 0.0, ok=False)
+                threading.Timer(REPLICA_RETRY_DELAY, lambda: [self.queue.put(j) for j in job_ids]).start()
+                return
+            status, error = 'failed', str(e)
+        if self.outbox: self.outbox.drop(job_ids)
+        with self.lock:
+            if status == 'committed':
+                revision, stale = result or (None, False)
+                jobs = [(j, self.jobs[j]['mutation']) for j in job_ids]
+                get_sheet_cache().commit(sheet_name, mutations, revision, stale, jobs)
+            for j in job_ids:
+                self.jobs[j].update(status=status, error=error)
+                self.pending[sheet_name].remove(j)
+            while len(self.jobs) > WRITE_JOB_HISTORY and next(iter(self.jobs.values()))['status'] != 'pending':
+                self.jobs.popitem(last=False)
+
+def get_write_queue():
+    return tenant_resource('gravacao', lambda: WriteBehindQueue(outbox=get_local_replica()))
+
+# ------------------------------------------------------------------------------
+# Réplica local (opcional, ligada por LOCAL_REPLICA_PATH): um SQLite com as abas, a
+# revisão e o cursor do registro de alterações de cada uma, e os jobs de gravação
+# pendentes. As leituras saem dela quando a cópia em memória falta; uma thread puxa as
+# alterações remotas a cada REPLICA_SYNC_INTERVAL e grava de volta só as linhas que
+# mudaram. Conflitos seguem a revisão da aba 'controle', como nas gravações diretas.
+# ------------------------------------------------------------------------------
+
+LOCAL_REPLICA_PATH = os.environ.get('LOCAL_REPLICA_PATH')
+REPLICA_SYNC_INTERVAL = float(os.environ.get('REPLICA_SYNC_INTERVAL', 60))
+REPLICA_RETRY_DELAY = 30
+
+# Erros de rede/cota/servidor: vale tentar de novo mais tarde
+def _is_outage(e):
+    if isinstance(e, ConflictError): return False
+    if isinstance(e, (SheetReadError, requests.ConnectionError, requests.Timeout)): return True
+    code = _status_code(e) or 0
+    return code == 429 or code >= 500
+
+class LocalReplica:
+    def __init__(self, path, interval=REPLICA_SYNC_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.flushed = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS planilhas (nome TEXT PRIMARY KEY, colunas TEXT, revisao INTEGER, log_row INTEGER)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS linhas (planilha TEXT, id INTEGER, dados TEXT, PRIMARY KEY (planilha, id))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS pendentes (seq INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT UNIQUE, planilha TEXT, mutacao TEXT)")
+        self.worker = threading.Thread(target=in_tenant(self._run), name=f'replica-sync-{tenant_slug()}', daemon=True)
+        self.worker.start()
+
+    # {aba: (df, revisão, cursor)} das abas que a réplica já tem
+    def load(self, sheet_names):
+        out = {}
+        with self.lock:
+            for name in sheet_names:
+                meta = self.db.execute("SELECT colunas, revisao, log_row FROM planilhas WHERE nome = ?", (name,)).fetchone()
+                if meta is None: continue
+                rows = self.db.execute("SELECT dados FROM linhas WHERE planilha = ? ORDER BY id", (name,)).fetchall()
+                values = [json.loads(meta[0])] + [json.loads(r[0]) for r in rows]
+                # Linhas em branco da aba não vão para a réplica: a conta sai do DataFrame
+                out[name] = (_values_to_frame(name, values), meta[1], meta[2], None)
+        return out
+
+    # Grava a cópia em memória da aba; se a linhagem só cresceu desde a última vez,
+    # regrava apenas as linhas tocadas pelas mutações novas
+    def save(self, sheet_name):
+        entry = get_sheet_cache().entry(sheet_name)
+        if entry is None: return
+        df, id_col = entry['df'], get_id_col(sheet_name)
+        columns = [id_col] + [c for c in df.columns if c != id_col]
+        job_ids = [j for j, _ in entry['applied']]
+        last = self.flushed.get(sheet_name)
+        incremental = last is not None and last[0] == entry['load_id'] and job_ids[:len(last[1])] == last[1]
+        if incremental:
+            touched = {int(m[1]) for _, m in entry['applied'][len(last[1]):]}
+            rows = df[df[id_col].isin(touched)]
+        else:
+            rows = df
+        records = [(sheet_name, int(r[0]), json.dumps([to_sheet_value(v) for v in r], ensure_ascii=False))
+                   for r in zip(*(rows[c].array for c in columns))]
+        with self.lock, self.db:
+            if incremental:
+                self.db.executemany("DELETE FROM linhas WHERE planilha = ? AND id = ?", [(sheet_name, t) for t in touched])
+            else:
+                self.db.execute("DELETE FROM linhas WHERE planilha = ?", (sheet_name,))
+            self.db.executemany("INSERT OR REPLACE INTO linhas VALUES (?, ?, ?)", records)
+            self.db.execute("INSERT OR REPLACE INTO planilhas VALUES (?, ?, ?, ?)",
+                            (sheet_name, json.dumps(columns), entry['revision'], entry['log_row']))
+        self.flushed[sheet_name] = (entry['load_id'], job_ids)
+
+    # Traz as alterações remotas para a memória e para o disco. Falhando a rede, as
+    # leituras continuam servidas pela cópia que já existe.
+    def pull(self):
+        with timed('replica_sync'):
+            names = tuple(EXPECTED_COLS)
+            refresh_cache(names)
+            for name in names: self.save(name)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.pull()
+            except Exception:
+                # Falha já registrada nas métricas (replica_sync); tenta de novo no próximo ciclo
+                pass
+
+    def push(self, job_id, sheet_name, mutation):
+        op, id_value, data = mutation
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO pendentes (job_id, planilha, mutacao) VALUES (?, ?, ?)",
+                            (job_id, sheet_name, json.dumps([op, int(id_value), _dump_data(data)])))
+
+    def drop(self, job_ids):
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM pendentes WHERE job_id = ?", [(j,) for j in job_ids])
+
+    def pending(self):
+        with self.lock:
+            rows = self.db.execute("SELECT job_id, planilha, mutacao FROM pendentes ORDER BY seq").fetchall()
+        out = []
+        for job_id, sheet_name, raw in rows:
+            op, id_value, data = json.loads(raw)
+            out.append((job_id, sheet_name, (op, id_value, json.loads(data) if data else None)))
+        return out
+
+# Com mais de uma frota, cada uma tem o seu arquivo (sufixo com o id da planilha)
+def _replica_path():
+    if len(TENANTS) == 1: return LOCAL_REPLICA_PATH
+    root, ext = os.path.splitext(LOCAL_REPLICA_PATH)
+    return f'{root}_{tenant_slug()}{ext}'
+
+def get_local_replica():
+    return tenant_resource('replica', lambda: LocalReplica(_replica_path()) if LOCAL_REPLICA_PATH else None)
+
+# ------------------------------------------------------------------------------
+# Partida rápida: cada processo novo (deploy, escala) começava autenticando, abrindo a
+# planilha e baixando as três abas antes da primeira tela. Agora a primeira execução
+# dispara um aquecimento em segundo plano que carrega o último snapshot Parquet das abas
+# (SNAPSHOT_DIR; vazio desliga), importa os módulos pesados, abre o cliente e a planilha
+# e só então põe os dados em dia pelo registro de alterações. A primeira tela sai do
+# snapshot enquanto isso; cada fase vai para as métricas como 'inicializacao'.
+# ------------------------------------------------------------------------------
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'frota_snapshot'))
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', 600))
+
+def _snapshot_path(sheet_name):
+    return os.path.join(SNAPSHOT_DIR, f'{tenant_slug()}_{sheet_name}.parquet')
+
+# {aba: (df, revisão, cursor, idade em segundos)} dos snapshots ainda dentro do TTL
+def load_snapshot(sheet_names):
+    out = {}
+    if not SNAPSHOT_DIR: return out
+    for name in sheet_names:
+        try:
+            df = pd.read_parquet(_snapshot_path(name))
+        except Exception:
+            continue
+        meta, df.attrs = df.attrs, {}
+        age = max(time.time() - meta.get('gravado_em', 0), 0.0)
+        if age < SHEET_CACHE_TTL:
+            out[name] = (coerce_frame(name, df), meta.get('revisao'), meta.get('log_row', 1), age)
+    return out
+
+def save_snapshot(sheet_names):
+    if not SNAPSHOT_DIR: return
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    cache = get_sheet_cache()
+    for name in sheet_names:
+        entry = cache.entry(name)
+        if entry is None: continue
+        df = entry['df'].copy(deep=False)
+        # Idade contada desde a leitura da planilha, não desde a gravação do arquivo
+        df.attrs = {'revisao': entry['revision'], 'log_row': entry['log_row'],
+                    'gravado_em': time.time() - (time.monotonic() - entry['loaded_at'])}
+        path = _snapshot_path(name)
+        try:
+            df.to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+        except Exception:
+            # Coluna com tipos misturados (editada à mão) não vai para o Parquet: fica sem snapshot
+            get_metrics().cache('snapshot', 'erro')
+
+class Warmup:
+    def __init__(self, interval=SNAPSHOT_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.done = threading.Event()
+        self.started = None
+        self.phases = {}
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None: return
+            self.started = time.perf_counter()
+            self.thread = threading.Thread(target=in_tenant(self._run), name=f'warmup-{tenant_slug()}', daemon=True)
+            self.thread.start()
+
+    def warming(self):
+        return self.thread is not None and not self.done.is_set()
+
+    def phase(self, name, seconds=None):
+        if seconds is None: seconds = time.perf_counter() - self.started
+        self.phases[name] = seconds
+        get_metrics().record('inicializacao', name, seconds)
+
+    @contextlib.contextmanager
+    def _step(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase(name, time.perf_counter() - t0)
+
+    def _run(self):
+        names = tuple(EXPECTED_COLS)
+        cache = get_sheet_cache()
+        try:
+            with self._step('snapshot'):
+                for name, (df, revision, log_row, age) in load_snapshot(names).items():
+                    if cache.get(name) is None: cache.put(name, df, revision, log_row, age)
+            self.loaded.set()
+            with self._step('modulos'):
+                for module in ('gspread', 'altair'): importlib.import_module(module)
+            with self._step('cliente'):
+                # Sem contexto de tela o st.stop() não interrompe: não deixar o None no cache
+                if get_gspread_client() is None: get_gspread_client.clear()
+            with self._step('planilha'):
+                get_control_worksheet()
+                get_changelog_worksheet()
+                get_ticket_worksheet()
+                for name in names: get_worksheet(name)
+            with self._step('dados'):
+                refresh_cache(names)
+            with self._step('gravar_snapshot'):
+                save_snapshot(names)
+        except Exception:
+            # A primeira tela cai no caminho normal (leitura direta, com o erro na tela)
+            pass
+        finally:
+            self.loaded.set()
+            self.done.set()
+            self.phase('total')
+        self._keep_saving(names)
+
+    # Depois da partida, regrava o snapshot das abas que mudaram desde a última vez
+    def _keep_saving(self, names):
+        cache = get_sheet_cache()
+        saved = {name: cache.version(name) for name in names}
+        while SNAPSHOT_DIR:
+            time.sleep(self.interval)
+            changed = [name for name in names if cache.version(name) != saved[name]]
+            for name in changed: saved[name] = cache.version(name)
+            try:
+                save_snapshot(changed)
+            except Exception:
+                pass
+
+def get_warmup():
+    return tenant_resource('aquecimento', Warmup)
+
 # ==============================================================================
 # 2. CRUD E UTILITÁRIOS
 # ==============================================================================
 
+# Enfileira a operação e devolve o id do job (ou None se não houver o que gravar).
+# A mudança aparece na hora na cópia local; a gravação na planilha segue em segundo plano.
 def execute_crud_operation(sheet_name, data=None, id_value=None, operation='insert'):
-    df = get_sheet_data(sheet_name, force_refresh=True)
-    id_col = f'id_{sheet_name}' if sheet_name in ('veiculo', 'prestador') else 'id_servico'
+    # Sem uma leitura bem-sucedida não há base para gravar: recusa em vez de supor aba vazia
+    try:
+        df = get_sheet_data(sheet_name)
+    except SheetReadError as e:
+        st.error(f"❌ Gravação recusada: {e}")
+        return None
+    id_col = get_id_col(sheet_name)
 
     if operation == 'insert':
-        new_id = 1
-        if not df.empty and id_col in df.columns:
-            new_id = int(df[id_col].max() + 1)
+        try:
+            new_id = get_id_allocator().next_id(sheet_name)
+        except (ConflictError, SheetReadError, gspread.exceptions.APIError) as e:
+            st.warning(f"⚠️ {e}")
+            return None
         data[id_col] = new_id
-        df_updated = pd.concat([df, pd.DataFrame([data])], ignore_index=True).fillna("")
-        return write_sheet_data(sheet_name, df_updated)
+        mutation = ('insert', new_id, data)
 
     elif operation == 'update':
-        if df.empty: return False
-        idx = df[df[id_col] == int(id_value)].index
-        if not idx.empty:
-            for k, v in data.items(): df.loc[idx, k] = v
-            return write_sheet_data(sheet_name, df)
-        return False
+        if df.empty: return None
+        res = df[df[id_col] == int(id_value)]
+        if res.empty: return None
+        curr = res.iloc[0]
+        changed = {k: v for k, v in data.items() if k not in curr.index or not _same_value(curr[k], v)}
+        if not changed: return None
+        mutation = ('update', int(id_value), changed)
 
     elif operation == 'delete':
-        if df.empty: return False
-        df_updated = df[df[id_col] != int(id_value)]
-        return write_sheet_data(sheet_name, df_updated)
+        if df.empty: return None
+        mutation = ('delete', int(id_value), None)
+
+    job_id = get_write_queue().submit(sheet_name, mutation)
+    st.session_state.setdefault('write_jobs', {})[job_id] = 'pending'
+    return job_id
+
+# Traz para a sessão o status (pending/committed/failed) das gravações que ela enfileirou
+def sync_write_jobs():
+    jobs = st.session_state.setdefault('write_jobs', {})
+    write_queue = get_write_queue()
+    for job_id in list(jobs):
+        status, error = write_queue.status(job_id)
+        if status == 'failed' and jobs[job_id] == 'pending':
+            st.toast(f"❌ Falha ao gravar: {error}")
+            jobs[job_id] = status
+        elif status != 'pending':
+            # Já informado na execução anterior
+            del jobs[job_id]
+    return jobs
+
+# Descarta a cópia em memória; com a réplica local, já puxa as abas inteiras da planilha
+def refresh_all_data():
+    get_sheet_cache().invalidate()
+    replica = get_local_replica()
+    if replica is not None: replica.pull()
+
+# Devolve False se alguma aba não pôde ser compactada (o motivo já foi exibido)
+def compact_all_sheets():
+    get_write_queue().wait_idle()
+    done = [compact_sheet_data(sheet_name) for sheet_name in EXPECTED_COLS]
+    if not all(done): return False
+    # Com todas as abas em revisão nova, o registro antigo já não serve a ninguém
+    _gspread_call('resize', get_changelog_worksheet().resize, rows=1)
+    _trim_tickets()
+    return True
+
+# Consulta de CEP: uma sessão HTTP com keep-alive, cache em SQLite com validade e limite
+# de tamanho (CEPs inexistentes também ficam guardados, por menos tempo) e uma única
+# requisição em voo por CEP, compartilhada entre as sessões que pedirem o mesmo.
+CEP_BASE_URL = os.environ.get('CEP_BASE_URL', 'https://viacep.com.br/ws')
+CEP_CACHE_PATH = os.environ.get('CEP_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'cep_cache.sqlite'))
+CEP_CACHE_TTL = 30 * 24 * 3600
+CEP_NEGATIVE_TTL = 24 * 3600
+CEP_CACHE_MAX = 5000
+
+class CepLookupError(Exception):
+    pass
+
+def normalize_cep(cep):
+    cep = str(cep).replace("-", "").replace(".", "").strip()
+    return cep if len(cep) == 8 and cep.isdigit() else None
+
+class CepResolver:
+    def __init__(self, base_url=CEP_BASE_URL, cache_path=CEP_CACHE_PATH, max_entries=CEP_CACHE_MAX):
+        self.base_url = base_url.rstrip('/')
+        self.max_entries = max_entries
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(cache_path, check_same_thread=False)
+        with self.db_lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS cep (cep TEXT PRIMARY KEY, payload TEXT, expires REAL, used REAL)")
+
+    def _cached(self, cep):
+        now = time.time()
+        with self.db_lock, self.db:
+            row = self.db.execute("SELECT payload, expires FROM cep WHERE cep = ?", (cep,)).fetchone()
+            if row is None or row[1] < now: return False, None
+            self.db.execute("UPDATE cep SET used = ? WHERE cep = ?", (now, cep))
+        return True, json.loads(row[0])
+
+    def _store(self, cep, data):
+        now = time.time()
+        ttl = CEP_CACHE_TTL if data is not None else CEP_NEGATIVE_TTL
+        with self.db_lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO cep VALUES (?, ?, ?, ?)", (cep, json.dumps(data), now + ttl, now))
+            # LRU: descarta os menos usados quando passa do limite
+            self.db.execute("DELETE FROM cep WHERE cep IN (SELECT cep FROM cep ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def _fetch(self, cep):
+        try:
+            response = self.session.get(f"{self.base_url}/{cep}/json/", timeout=3)
+        except requests.RequestException as e:
+            raise CepLookupError(f"Falha ao consultar o CEP {cep}: {e}") from e
+        if response.status_code == 400: return None
+        if response.status_code != 200:
+            raise CepLookupError(f"Serviço de CEP respondeu {response.status_code} para {cep}.")
+        try:
+            data = response.json()
+        except ValueError as e:
+            raise CepLookupError(f"Resposta inválida do serviço de CEP para {cep}.") from e
+        return None if "erro" in data else data
+
+    def resolve(self, cep):
+        # None = CEP inexistente/inválido; CepLookupError = falha de rede (não vai para o cache)
+        cep = normalize_cep(cep)
+        if cep is None: return None
+        found, data = self._cached(cep)
+        if found: return data
+
+        with self.lock:
+            future = self.inflight.get(cep)
+            owner = future is None
+            if owner: future = self.inflight[cep] = Future()
+        if not owner: return future.result()
+
+        try:
+            data = self._fetch(cep)
+            self._store(cep, data)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock: self.inflight.pop(cep, None)
+
+    def resolve_many(self, ceps, max_workers=8):
+        # {cep normalizado: dados ou None}; CEPs cuja consulta falhou ficam de fora
+        unique = list(dict.fromkeys(c for c in map(normalize_cep, ceps) if c))
+        results = {}
+        if not unique: return results
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(unique))) as pool:
+            futures = {cep: pool.submit(self.resolve, cep) for cep in unique}
+        for cep, future in futures.items():
+            try: results[cep] = future.result()
+            except CepLookupError: pass
+        return results
+
+@st.cache_resource
+def get_cep_resolver():
+    return CepResolver()
 
 def consultar_cep(cep):
-    cep_limpo = str(cep).replace("-", "").replace(".", "").strip()
-    if len(cep_limpo) == 8:
+    return get_cep_resolver().resolve(cep)
+
+# Preenche endereço/bairro/cidade vazios dos prestadores a partir do CEP já cadastrado
+def backfill_provider_addresses():
+    df = get_sheet_data('prestador')
+    if df.empty: return 0
+    fields = {'endereco': 'logradouro', 'bairro': 'bairro', 'cidade': 'localidade'}
+    blank = df[list(fields)].astype(str).apply(lambda col: col.str.strip() == '')
+    df = df[blank.any(axis=1) & df['cep'].map(normalize_cep).notna()]
+    found = get_cep_resolver().resolve_many(df['cep'])
+
+    updated = 0
+    for _, row in df.iterrows():
+        data = found.get(normalize_cep(row['cep']))
+        if not data: continue
+        payload = {col: data.get(key, '') for col, key in fields.items() if not str(row[col]).strip() and data.get(key)}
+        if payload and execute_crud_operation('prestador', data=payload, id_value=row['id_prestador'], operation='update'):
+            updated += 1
+    return updated
+
+# ------------------------------------------------------------------------------
+# Importação em lote: o arquivo (CSV ou XLSX) é lido em blocos, cada bloco é validado
+# e tipado pelo SCHEMA, nomes de veículo/prestador viram ids por lookup vetorizado,
+# os ids saem de uma única reserva e a gravação vai em poucos append_rows grandes.
+# É tudo ou nada: com qualquer linha inválida nada é gravado.
+# ------------------------------------------------------------------------------
+IMPORT_CHUNK_ROWS = 1000
+IMPORT_BATCH_ROWS = 2000
+IMPORT_MAX_ERRORS = 200
+REQUIRED_COLS = {'veiculo': ['nome'], 'prestador': ['empresa'], 'servico': ['nome_servico', 'data_servico', 'valor']}
+# Colunas de nome aceitas no lugar dos ids de referência, e por quais campos são procuradas
+NAME_REFS = {'servico': {'id_veiculo': ('veiculo', 'veiculo', ['nome', 'placa']),
+                         'id_prestador': ('prestador', 'prestador', ['empresa'])}}
+
+def _read_upload_chunks(upload, chunk_rows=IMPORT_CHUNK_ROWS):
+    if getattr(upload, 'name', '').lower().endswith('.xlsx'):
         try:
-            response = requests.get(f"https://viacep.com.br/ws/{cep_limpo}/json/", timeout=3)
-            if response.status_code == 200:
-                data = response.json()
-                if "erro" not in data:
-                    return data
-        except:
-            return None
-    return None
+            import openpyxl
+        except ImportError:
+            raise ValueError("Para importar .xlsx instale o pacote openpyxl (ou salve a planilha como CSV).")
+        wb = openpyxl.load_workbook(upload, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            header = ['' if c is None else str(c) for c in next(rows, ())]
+            for chunk in iter(lambda: list(itertools.islice(rows, chunk_rows)), []):
+                yield pd.DataFrame([list(r)[:len(header)] for r in chunk], columns=header, dtype=object)
+        finally:
+            wb.close()
+    else:
+        # sep=None detecta vírgula ou ponto e vírgula (CSV salvo pelo Excel em português)
+        yield from pd.read_csv(upload, chunksize=chunk_rows, dtype=str, keep_default_na=False,
+                               sep=None, engine='python', encoding='utf-8-sig')
+
+def _name_lookup(df, id_col, name_cols):
+    keys = pd.concat([df[c].astype(str).str.strip().str.lower() for c in name_cols], ignore_index=True)
+    ids = np.tile(df[id_col].to_numpy(), len(name_cols))
+    lookup = pd.Series(ids, index=keys.to_numpy())
+    return lookup[~lookup.index.duplicated(keep='first') & (lookup.index != '')]
+
+def _clean_text(chunk):
+    return chunk.fillna('').astype(str).apply(lambda col: col.str.strip())
+
+def _validate_chunk(sheet_name, chunk, first_line, lookups):
+    schema = SCHEMA[sheet_name]
+    raw = _clean_text(chunk.rename(columns=lambda c: str(c).strip().lower()))
+    errors = []
+    line = pd.Series(np.arange(first_line, first_line + len(raw)), index=raw.index)
+    bad = pd.Series(False, index=raw.index)
+
+    def flag(mask, message):
+        nonlocal bad
+        for n in line[mask & ~bad].head(IMPORT_MAX_ERRORS):
+            errors.append({'linha': int(n), 'erro': message})
+        bad = bad | mask
+
+    for col in REQUIRED_COLS[sheet_name]:
+        if col not in raw.columns:
+            raise ValueError(f"Coluna obrigatória ausente: '{col}'. Esperado: {', '.join(EXPECTED_COLS[sheet_name])}")
+        flag(raw[col] == '', f"'{col}' vazio")
+
+    for col, column in schema.items():
+        if col not in raw.columns or column.dtype in ('object', 'category'): continue
+        values = raw[col]
+        if column.dtype != 'datetime64[ns]':
+            # Aceita 1.234,56 além de 1234.56
+            comma = values.str.contains(',', regex=False)
+            values = values.where(~comma, values.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+            raw[col] = values
+        if column.dtype == 'datetime64[ns]':
+            parsed = pd.to_datetime(values.replace('', None), errors='coerce', format='mixed', dayfirst=True)
+        else:
+            parsed = pd.to_numeric(values.replace('', None), errors='coerce')
+        flag(parsed.isna() & (values != ''), f"valor inválido em '{col}'")
+
+    # O id vem da reserva; colunas fora do layout são ignoradas
+    typed = coerce_frame(sheet_name, raw[[c for c in raw.columns if c in schema and c != get_id_col(sheet_name)]])
+    for ref, (alias, _, _) in NAME_REFS.get(sheet_name, {}).items():
+        by_name, known_ids = lookups[ref]
+        given = typed[ref] > 0
+        if alias in raw.columns:
+            resolved = raw[alias].str.lower().map(by_name)
+            typed[ref] = typed[ref].where(given, resolved.fillna(0)).astype('int32')
+            flag(~given & (raw[alias] != '') & resolved.isna(), f"{alias} não encontrado")
+        flag(given & ~typed[ref].isin(known_ids), f"'{ref}' não existe")
+    if sheet_name == 'servico':
+        flag(typed['id_veiculo'] <= 0, "veículo não informado")
+        prazo = pd.to_timedelta(typed['garantia_dias'].fillna(0).astype('int64'), unit='D')
+        typed['data_vencimento'] = typed['data_vencimento'].fillna(typed['data_servico'] + prazo)
+
+    return typed[~bad.to_numpy()], errors
+
+def import_records(sheet_name, upload, dry_run=False, progress=None):
+    # Devolve (linhas válidas, erros, linhas gravadas)
+    get_write_queue().wait_idle()
+    lookups = {}
+    for ref, (_, source, name_cols) in NAME_REFS.get(sheet_name, {}).items():
+        df_ref = get_sheet_data(source)
+        lookups[ref] = (_name_lookup(df_ref, get_id_col(source), name_cols), df_ref[get_id_col(source)])
+
+    valid, errors, line = [], [], 2
+    for chunk in _read_upload_chunks(upload):
+        typed, chunk_errors = _validate_chunk(sheet_name, chunk, line, lookups)
+        valid.append(typed)
+        errors += chunk_errors[:IMPORT_MAX_ERRORS - len(errors)]
+        line += len(chunk)
+    df = concat_typed(valid) if valid else empty_frame(sheet_name)
+    errors.sort(key=lambda e: e['linha'])
+    if errors or df.empty or dry_run:
+        return len(df), errors, 0
+
+    id_col = get_id_col(sheet_name)
+    df[id_col] = np.array(get_id_allocator().reserve(sheet_name, len(df)), dtype='int32')
+    records = df[EXPECTED_COLS[sheet_name]].to_dict('records')
+    cache = get_sheet_cache()
+    batch_id = uuid.uuid4().hex
+    for start in range(0, len(records), IMPORT_BATCH_ROWS):
+        batch = [('insert', r[id_col], r) for r in records[start:start + IMPORT_BATCH_ROWS]]
+        revision, stale = write_sheet_delta(sheet_name, batch)
+        cache.commit(sheet_name, batch, revision, stale, [(f'import-{batch_id}-{m[1]}', m) for m in batch])
+        if progress: progress(min(1.0, (start + len(batch)) / len(records)))
+    return len(df), [], len(records)
+
+# Exportação do histórico: o CSV é gerado em blocos direto num buffer de bytes,
+# sem montar a tabela inteira como texto de uma vez
+EXPORT_CHUNK_ROWS = 5000
+EXPORT_COLS = ['nome', 'placa', 'empresa', 'nome_servico', 'data_servico', 'garantia_dias', 'valor',
+               'km_realizado', 'km_proxima_revisao', 'registro', 'data_vencimento']
+
+def export_csv(df, cols=EXPORT_COLS, chunk_rows=EXPORT_CHUNK_ROWS):
+    buf = io.BytesIO()
+    buf.write('\ufeff'.encode('utf-8'))
+    cols = [c for c in cols if c in df.columns]
+    for start in range(0, max(len(df), 1), chunk_rows):
+        df.iloc[start:start + chunk_rows][cols].to_csv(buf, index=False, header=start == 0, date_format='%Y-%m-%d', encoding='utf-8')
+    return buf.getvalue()
 
 # ==============================================================================
 # 3. RELATÓRIOS
 # ==============================================================================
 
+# Visão consolidada (serviço + veículo + prestador) materializada uma vez e compartilhada
+# entre abas e sessões. Ela é chaveada pela linhagem das três abas: se só entraram
+# mutações novas de serviço, a visão é remendada linha a linha em vez de refeita.
+class ServiceView:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.df = pd.DataFrame()
+        self.lineage = None
+        self.version = 0
+        self.sized = (None, 0)
+
+    def nbytes(self):
+        with self.lock:
+            df, version = self.df, self.version
+        if self.sized[0] != version: self.sized = (version, estimate_nbytes(df))
+        return self.sized[1]
+
+    # A versão continua contando: quem guardou resultados pela versão não os confunde
+    def release(self):
+        with self.lock:
+            self.df = pd.DataFrame()
+            self.lineage = None
+            self.sized = (None, 0)
+
+def get_service_view():
+    return tenant_resource('visao', ServiceView)
+
+def _job_ids(lineage):
+    return [job_id for job_id, _ in lineage[1]]
+
+def _extends(old, new):
+    old_ids, new_ids = _job_ids(old), _job_ids(new)
+    return old[0] is not None and old[0] == new[0] and new_ids[:len(old_ids)] == old_ids
+
 def get_full_service_data():
-    df_s = get_sheet_data('servico')
-    df_v = get_sheet_data('veiculo')
-    df_p = get_sheet_data('prestador')
+    return _service_view_snapshot()[0]
+
+def _service_view_snapshot():
+    with timed('visao_servicos'):
+        return _refresh_service_view()
 
+def _refresh_service_view():
+    snapshot = get_sheets_snapshot(tuple(EXPECTED_COLS))
+    (df_v, lin_v), (df_p, lin_p), (df_s, lin_s) = (snapshot[name] for name in EXPECTED_COLS)
+    view = get_service_view()
+    with view.lock:
+        if view.lineage is not None:
+            old_v, old_p, old_s = view.lineage
+            if _job_ids(old_v) == _job_ids(lin_v) and old_v[0] == lin_v[0] \
+                    and _job_ids(old_p) == _job_ids(lin_p) and old_p[0] == lin_p[0] and _extends(old_s, lin_s):
+                new_jobs = lin_s[1][len(old_s[1]):]
+                get_metrics().cache('visao_servicos', 'patch' if new_jobs else 'hit')
+                view.lineage = (lin_v, lin_p, lin_s)
+                if not new_jobs: return view.df, view.version
+                view.df = _patch_service_view(view.df, [m for _, m in new_jobs], df_v, df_p, df_s)
+            else:
+                view.lineage = None
+        if view.lineage is None:
+            get_metrics().cache('visao_servicos', 'miss')
+            view.df = _build_service_view(df_v, df_p, df_s)
+            view.lineage = (lin_v, lin_p, lin_s)
+        view.version += 1
+        result = view.df, view.version
+    # A visão nova pode passar do limite de memória: as outras frotas cedem espaço
+    get_tenant_store().trim(keep=current_tenant())
+    return result
+
+def _fill_category(series, value):
+    if not isinstance(series.dtype, pd.CategoricalDtype): series = series.astype('category')
+    if value not in series.cat.categories: series = series.cat.add_categories([value])
+    return series.fillna(value)
+
+def _build_service_view(df_v, df_p, df_s):
     if df_s.empty: return pd.DataFrame()
 
-    df_s['id_veiculo'] = pd.to_numeric(df_s['id_veiculo'], errors='coerce').fillna(0).astype(int)
-    df_s['id_prestador'] = pd.to_numeric(df_s['id_prestador'], errors='coerce').fillna(0).astype(int)
-    
+    # As abas já chegam tipadas pelo SCHEMA: aqui só junta, completa e ordena
     if not df_v.empty:
-        df_v['id_veiculo'] = pd.to_numeric(df_v['id_veiculo'], errors='coerce').fillna(0).astype(int)
         df_merged = pd.merge(df_s, df_v[['id_veiculo', 'nome', 'placa']], on='id_veiculo', how='left')
     else:
-        df_merged = df_s.copy()
-        df_merged['nome'] = 'Desconhecido'
-        df_merged['placa'] = '-'
+        df_merged = df_s.assign(nome='Desconhecido', placa='-')
 
     if not df_p.empty:
-        df_p['id_prestador'] = pd.to_numeric(df_p['id_prestador'], errors='coerce').fillna(0).astype(int)
         df_merged = pd.merge(df_merged, df_p[['id_prestador', 'empresa']], on='id_prestador', how='left')
     else:
-        df_merged['empresa'] = 'Desconhecido'
+        df_merged = df_merged.assign(empresa='Desconhecido')
 
-    df_merged['nome'] = df_merged['nome'].fillna('Desconhecido').astype(str)
-    df_merged['empresa'] = df_merged['empresa'].fillna('Desconhecido').astype(str)
+    df_merged['nome'] = _fill_category(df_merged['nome'], 'Desconhecido')
+    df_merged['empresa'] = _fill_category(df_merged['empresa'], 'Desconhecido')
+    df_merged['placa'] = df_merged['placa'].astype('category')
+    df_merged['Ano'] = df_merged['data_servico'].dt.year.astype('Int16')
     
-    df_merged['data_vencimento'] = pd.to_datetime(df_merged['data_vencimento'], errors='coerce')
-    df_merged['data_servico'] = pd.to_datetime(df_merged['data_servico'], errors='coerce')
-    df_merged['valor'] = pd.to_numeric(df_merged['valor'], errors='coerce').fillna(0.0)
-    df_merged['Dias p/ Vencer'] = (df_merged['data_vencimento'] - pd.to_datetime(date.today())).dt.days
-    
-    return df_merged.sort_values(by='data_servico', ascending=False)
+    return df_merged.sort_values(by='data_servico', ascending=False).reset_index(drop=True)
+
+def _desc_date_key(dates):
+    # Chave crescente equivalente à ordem "data decrescente, vazias no fim"
+    raw = dates.to_numpy(dtype='datetime64[ns]').view('int64')
+    key = np.full(len(raw), np.iinfo(np.int64).max, dtype='int64')
+    valid = ~np.isnat(dates.to_numpy(dtype='datetime64[ns]'))
+    key[valid] = -raw[valid]
+    return key
+
+def _patch_service_view(view, mutations, df_v, df_p, df_s):
+    touched = {int(id_value) for _, id_value, _ in mutations}
+    base = view[~view['id_servico'].isin(touched)] if not view.empty else view
+    fresh = _build_service_view(df_v, df_p, df_s[df_s['id_servico'].isin(touched)])
+    if fresh.empty: return base.reset_index(drop=True)
+    if base.empty: return fresh
+
+    # Insere as linhas novas já na posição certa, sem reordenar a visão inteira
+    pos = np.searchsorted(_desc_date_key(base['data_servico']), _desc_date_key(fresh['data_servico']), side='right')
+    order = np.insert(np.arange(len(base)), pos, np.arange(len(base), len(base) + len(fresh)))
+    return concat_typed([base, fresh]).iloc[order].reset_index(drop=True)
+
+# Resultados derivados da visão (agregados, índices...) guardados junto com a versão
+# da visão de que vieram; só são refeitos quando ela muda.
+class DerivedCache:
+    def __init__(self, name=None):
+        self.name = name
+        self.lock = threading.Lock()
+        self.key = None
+        self.value = None
+        self.sized = None
+
+    def get(self, key, build):
+        with self.lock:
+            hit = self.key == key
+            if not hit:
+                self.value = build()
+                self.key = key
+                self.sized = None
+            if self.name: get_metrics().cache(self.name, 'hit' if hit else 'miss')
+            value = self.value
+        if not hit: get_tenant_store().trim(keep=current_tenant())
+        return value
+
+    def nbytes(self):
+        with self.lock:
+            if self.sized is None: self.sized = estimate_nbytes(self.value)
+            return self.sized
+
+    def release(self):
+        with self.lock:
+            self.key = self.value = None
+            self.sized = None
+
+def get_derived_cache(name):
+    return tenant_resource(('derivado', name), lambda: DerivedCache(name))
+
+# Cubo de gastos: soma e contagem de 'valor' por (ano, veículo), (ano, prestador) e
+# (mês, veículo). Qualquer combinação de filtros do Resumo vira uma consulta ao cubo.
+def build_spend_cube(df_full):
+    valor = df_full['valor'].astype('float64')
+    keys = {
+        'Ano': df_full['Ano'], 'nome': df_full['nome'], 'empresa': df_full['empresa'],
+        'Mes': df_full['data_servico'].dt.to_period('M'),
+    }
+    def agg(*cols): return valor.groupby([keys[c] for c in cols], dropna=False, observed=True).agg(['sum', 'count'])
+
+    ano_veiculo = agg('Ano', 'nome')
+    return {
+        'ano_veiculo': ano_veiculo,
+        'ano_prestador': agg('Ano', 'empresa'),
+        'mes_veiculo': agg('Mes', 'nome'),
+        'por_veiculo': ano_veiculo.groupby(level='nome', observed=True).sum(),
+        'anos': sorted(df_full['Ano'].dropna().unique().astype(int).tolist(), reverse=True),
+        'veiculos': sorted(df_full['nome'].astype(str).unique().tolist()),
+    }
+
+def get_spend_cube():
+    df_full, version = _service_view_snapshot()
+    if df_full.empty: return None
+    return get_derived_cache('spend_cube').get(version, lambda: build_spend_cube(df_full))
+
+# Devolve (total, quantidade, gastos por veículo) para o filtro pedido
+def spend_lookup(cube, ano="Todos", veiculo="Todos"):
+    if ano == "Todos":
+        by_vehicle = cube['por_veiculo']
+    else:
+        av = cube['ano_veiculo']
+        by_vehicle = av.loc[ano] if ano in av.index.levels[0] else av.iloc[:0].droplevel(0)
+    if veiculo != "Todos":
+        by_vehicle = by_vehicle[by_vehicle.index == veiculo]
+    df_chart = by_vehicle['sum'].rename('valor').rename_axis('nome').reset_index().astype({'nome': str})
+    return float(by_vehicle['sum'].sum()), int(by_vehicle['count'].sum()), df_chart
+
+# Análises de custo sobre a visão consolidada: custo por km (pelos avanços do odômetro
+# de cada veículo), gasto mensal e em 12 meses móveis, participação dos prestadores e
+# projeção do ano. Só operações vetorizadas; o resultado é guardado por versão da visão
+# e por dia, já que a projeção depende de hoje.
+def build_analytics(df_full, today=None):
+    today = pd.Timestamp(today or date.today()).normalize()
+    df = df_full[df_full['data_servico'].notna()]
+    valor = df['valor'].astype('float64').fillna(0.0)
+    # Agrupar pelos códigos da categoria evita converter 100k nomes em texto
+    nome = df['nome'].astype('category')
+    datas = df['data_servico']
+    def by_name(values, mask=None):
+        if mask is not None: values = values[mask]
+        out = values.groupby(nome if mask is None else nome[mask], observed=True).sum()
+        return out.set_axis(out.index.astype(str))
+
+    # Km rodados: soma das diferenças de odômetro entre serviços consecutivos do veículo
+    km = pd.DataFrame({'id': df['id_veiculo'], 'data': datas, 'km': df['km_realizado'].astype('float64')}).dropna()
+    km = km.sort_values(['id', 'data'], kind='stable')
+    rodado = km.groupby('id')['km'].diff().clip(lower=0).groupby(km['id']).sum()
+    nome_do_id = pd.Series(nome.cat.codes.to_numpy(), index=df['id_veiculo'].to_numpy())
+    nome_do_id = nome_do_id[~nome_do_id.index.duplicated()]
+    km_rodado = rodado.groupby(nome.cat.categories[nome_do_id.reindex(rodado.index).to_numpy()].astype(str)).sum()
+
+    ultimos_12m = (datas > today - pd.DateOffset(months=12)) & (datas <= today)
+    no_ano = (datas >= pd.Timestamp(today.year, 1, 1)) & (datas <= today)
+    resto_do_ano = (pd.Timestamp(today.year, 12, 31) - today).days / 365
+    veiculos = pd.DataFrame({
+        'gasto': by_name(valor),
+        'km_rodado': km_rodado,
+        'gasto_12m': by_name(valor, ultimos_12m),
+        'gasto_ano': by_name(valor, no_ano),
+    }).fillna({'km_rodado': 0.0, 'gasto_12m': 0.0, 'gasto_ano': 0.0})
+    veiculos['custo_km'] = veiculos['gasto'] / veiculos['km_rodado'].where(veiculos['km_rodado'] > 0)
+    # Projeção: o que já foi gasto no ano mais o ritmo dos últimos 12 meses no que falta
+    veiculos['projecao_ano'] = veiculos['gasto_ano'] + veiculos['gasto_12m'] * resto_do_ano
+
+    # Meses x veículos, com os meses sem serviço zerados: um bincount sobre o índice
+    # (mês, veículo) monta a matriz inteira de uma vez
+    mes = datas.to_numpy().astype('datetime64[M]').astype('int64')
+    codes, n_nomes = nome.cat.codes.to_numpy(), len(nome.cat.categories)
+    if len(mes):
+        primeiro, n_meses = mes.min(), int(mes.max() - mes.min()) + 1
+        matriz = np.bincount((mes - primeiro) * n_nomes + codes, weights=valor.to_numpy(), minlength=n_meses * n_nomes)
+        usados = np.bincount(codes, minlength=n_nomes) > 0
+        mensal = pd.DataFrame(matriz.reshape(n_meses, n_nomes)[:, usados],
+                              index=pd.date_range(np.datetime64(int(primeiro), 'M'), periods=n_meses, freq='MS'),
+                              columns=nome.cat.categories[usados].astype(str))
+    else:
+        mensal = pd.DataFrame(index=pd.DatetimeIndex([], freq='MS'))
+
+    prestadores = valor.groupby(df['empresa'].astype('category'), observed=True).sum()
+    prestadores = prestadores.set_axis(prestadores.index.astype(str)).sort_values(ascending=False)
+    return {
+        'veiculos': veiculos,
+        'mensal': mensal,
+        'movel_12m': mensal.sum(axis=1).rolling(12, min_periods=1).sum(),
+        'prestadores': prestadores / prestadores.sum() if prestadores.sum() else prestadores,
+        'hoje': today,
+    }
+
+def get_analytics():
+    df_full, version = _service_view_snapshot()
+    if df_full.empty: return None
+    today = date.today()
+    return get_derived_cache('analises').get((version, today), lambda: build_analytics(df_full, today))
+
+# Recorte das análises para o filtro do Resumo: (por veículo, gasto mensal, 12 meses móveis)
+def analytics_lookup(an, ano="Todos", veiculo="Todos"):
+    veiculos, mensal, movel = an['veiculos'], an['mensal'], an['movel_12m']
+    if veiculo != "Todos":
+        # A janela móvel da frota já vem pronta; a de um veículo sai da coluna dele
+        veiculos = veiculos[veiculos.index == veiculo]
+        mensal = mensal[veiculo] if veiculo in mensal.columns else mensal.iloc[:, :0].sum(axis=1)
+        movel = mensal.rolling(12, min_periods=1).sum()
+    else:
+        mensal = mensal.sum(axis=1)
+    if ano != "Todos":
+        mensal, movel = mensal[mensal.index.year == ano], movel[movel.index.year == ano]
+    tendencia = pd.DataFrame({'mes': mensal.index, 'mensal': mensal.to_numpy(), 'movel_12m': movel.to_numpy()})
+    return veiculos, tendencia
+
+# Participação dos maiores prestadores, com o resto somado em "Outros"
+def provider_share(an, top=8):
+    share = an['prestadores']
+    out = share.head(top).rename_axis('empresa').rename('participacao').reset_index()
+    if len(share) > top:
+        out.loc[len(out)] = ["Outros", share.iloc[top:].sum()]
+    return out
+
+# Histórico: filtro e ordenação devolvem só as posições das linhas na visão, sem copiar
+# o frame; quem exibe pega apenas a janela da página atual
+HIST_SORTS = {
+    "Data (recentes)": ('data_servico', False), "Data (antigos)": ('data_servico', True),
+    "Valor (maior)": ('valor', False), "Vencimento": ('data_vencimento', True),
+}
+
+def history_positions(df_full, veiculo="Todos", ano="Todos", ids=None, sort="Data (recentes)"):
+    mask = np.ones(len(df_full), dtype=bool)
+    if veiculo != "Todos": mask &= (df_full['nome'] == veiculo).to_numpy()
+    if ano != "Todos": mask &= (df_full['Ano'] == ano).fillna(False).to_numpy(dtype=bool)
+    if ids is not None: mask &= df_full['id_servico'].isin(ids).to_numpy()
+    pos = np.flatnonzero(mask)
+    sort_col, ascending = HIST_SORTS[sort]
+    # A visão já vem em data decrescente
+    if (sort_col, ascending) == ('data_servico', False): return pos
+    keys = _sortable(df_full[sort_col].iloc[pos])
+    # argsort deixa NaN no fim nas duas direções (-NaN continua NaN)
+    return pos[np.argsort(keys if ascending else -keys, kind='stable')]
+
+def _sortable(values):
+    if np.issubdtype(values.dtype, np.datetime64):
+        raw = values.to_numpy(dtype='datetime64[ns]')
+        out = raw.astype('int64').astype('float64')
+        out[np.isnat(raw)] = np.nan
+        return out
+    return values.to_numpy(dtype='float64', na_value=np.nan)
+
+# Depende da data de hoje: calculada só na hora de exibir, sobre as linhas exibidas
+def with_days_to_due(df):
+    return df.assign(**{'Dias p/ Vencer': (df['data_vencimento'] - pd.to_datetime(date.today())).dt.days})
+
+# Agenda de manutenção: listas ordenadas com o vencimento da garantia de cada serviço e
+# a km que falta para a próxima revisão de cada veículo. As consultas são buscas
+# binárias; mutações novas na aba de serviços reindexam só os serviços e veículos tocados.
+class MaintenanceIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lineage = None
+        self.services = {}                                 # id_servico -> (veículo, vencimento, km, próxima km, data)
+        self.by_vehicle = collections.defaultdict(set)
+        self.expiry = []                                   # [(vencimento, id_servico)], datas como ordinal
+        self.revision = {}                                 # id_veiculo -> (km restantes, km atual, próxima revisão)
+        self.revision_order = []                           # [(km restantes, id_veiculo)]
+
+    def load(self, rows):
+        self.services = {}
+        self.by_vehicle = collections.defaultdict(set)
+        for sid, vid, due, km, km_next, when in rows:
+            self.services[sid] = (vid, due, km, km_next, when)
+            self.by_vehicle[vid].add(sid)
+        # Carga completa: cada lista é ordenada uma vez só, no fim
+        self.expiry = sorted((e[1], sid) for sid, e in self.services.items() if e[1] is not None)
+        self.revision = {vid: r for vid in self.by_vehicle if (r := self._revision(vid)) is not None}
+        self.revision_order = sorted((r[0], vid) for vid, r in self.revision.items())
+
+    def update(self, service_ids, rows):
+        vehicles = {self._remove(sid) for sid in service_ids}
+        for row in rows:
+            self._add(*row)
+            vehicles.add(row[1])
+        for vid in vehicles - {None}: self._reindex_vehicle(vid)
+
+    def _add(self, sid, vid, due, km, km_next, when):
+        self.services[sid] = (vid, due, km, km_next, when)
+        self.by_vehicle[vid].add(sid)
+        if due is not None: bisect.insort(self.expiry, (due, sid))
+
+    def _remove(self, sid):
+        entry = self.services.pop(sid, None)
+        if entry is None: return None
+        vid, due = entry[0], entry[1]
+        self.by_vehicle[vid].discard(sid)
+        if due is not None: _remove_sorted(self.expiry, (due, sid))
+        return vid
+
+    # (km restantes, km atual, próxima revisão) do veículo, ou None sem km informada
+    def _revision(self, vid):
+        entries = [self.services[sid] for sid in self.by_vehicle.get(vid, ())]
+        kms = [e[2] for e in entries if e[2] is not None]
+        # Vale a próxima revisão marcada no serviço mais recente que a informou
+        planned = [(e[4] or 0, e[2] or 0, e[3]) for e in entries if e[3] is not None]
+        if not kms or not planned: return None
+        current, target = max(kms), max(planned)[2]
+        return target - current, current, target
+
+    def _reindex_vehicle(self, vid):
+        old = self.revision.pop(vid, None)
+        if old is not None: _remove_sorted(self.revision_order, (old[0], vid))
+        revision = self._revision(vid)
+        if revision is None: return
+        self.revision[vid] = revision
+        bisect.insort(self.revision_order, (revision[0], vid))
+
+    # [(id_servico, dias para vencer)] das garantias que vencem entre hoje e hoje + days
+    def expiring(self, days, today=None):
+        start = (today or date.today()).toordinal()
+        lo = bisect.bisect_left(self.expiry, (start, -1))
+        hi = bisect.bisect_right(self.expiry, (start + days, float('inf')))
+        return [(sid, due - start) for due, sid in self.expiry[lo:hi]]
+
+    # [(id_veiculo, km restantes, km atual, próxima revisão)] a até `km` da revisão (ou já passados)
+    def near_revision(self, km):
+        hi = bisect.bisect_right(self.revision_order, (km, float('inf')))
+        return [(vid,) + self.revision[vid] for _, vid in self.revision_order[:hi]]
+
+def _remove_sorted(items, item):
+    i = bisect.bisect_left(items, item)
+    if i < len(items) and items[i] == item: del items[i]
+
+def get_maintenance_index():
+    return tenant_resource('manutencao', MaintenanceIndex)
+
+# Linhas (id_servico, id_veiculo, vencimento, km, próxima km, data) para o índice, com
+# None nas células vazias
+def _maintenance_rows(df_s):
+    epoch = date(1970, 1, 1).toordinal()
+    # Conversão da coluna inteira; o array de objetos já sai com int do Python e None
+    def nullable(values, missing):
+        out = values.astype(object)
+        out[missing] = None
+        return out.tolist()
+    def ordinals(col):
+        days = df_s[col].to_numpy(dtype='datetime64[D]')
+        return nullable(days.astype('int64') + epoch, np.isnat(days))
+    def ints(col):
+        values = df_s[col].astype('float64').to_numpy()
+        missing = np.isnan(values)
+        return nullable(np.where(missing, 0, values).astype('int64'), missing)
+    return list(zip(ints('id_servico'), ints('id_veiculo'), ordinals('data_vencimento'),
+                    ints('km_realizado'), ints('km_proxima_revisao'), ordinals('data_servico')))
+
+def _refresh_maintenance_index(index):
+    df_s, lineage = get_sheets_snapshot(('servico',))['servico']
+    if index.lineage is not None and _extends(index.lineage, lineage):
+        new_jobs = lineage[1][len(index.lineage[1]):]
+        get_metrics().cache('manutencao', 'patch' if new_jobs else 'hit')
+        if new_jobs:
+            touched = {int(id_value) for _, (_, id_value, _) in new_jobs}
+            index.update(touched, _maintenance_rows(df_s[df_s['id_servico'].isin(touched)]))
+    else:
+        get_metrics().cache('manutencao', 'miss')
+        index.load(_maintenance_rows(df_s))
+    index.lineage = lineage
+
+# Devolve (garantias vencendo em até `days` dias, veículos a até `km` km da revisão)
+def maintenance_alerts(days, km):
+    index = get_maintenance_index()
+    with timed('agenda_manutencao'), index.lock:
+        _refresh_maintenance_index(index)
+        return index.expiring(days), index.near_revision(km)
+
+# Busca por prefixo: índice invertido token -> registros, com o vocabulário ordenado para
+# achar todos os tokens que começam pelo termo digitado com duas buscas binárias. Segue a
+# linhagem de cada aba: mutações novas reindexam só os registros tocados.
+SEARCH_FIELDS = {'veiculo': ['nome', 'placa'], 'prestador': ['empresa'], 'servico': ['nome_servico', 'registro']}
+
+# Termos da consulta, normalizados como os tokens do índice
+def _search_tokens(text):
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode().lower()
+    return re.findall(r'[a-z0-9]+', text)
+
+# Texto das células, com vazio no lugar de NaN/NaT (categorias incluídas)
+def _search_text(col):
+    return col.astype(object).where(col.notna(), '').astype(str)
+
+def _search_labels(sheet_name, df):
+    if sheet_name == 'veiculo':
+        placa = _search_text(df['placa'])
+        return (_search_text(df['nome']) + ' (' + placa.where(placa != '', 'S/P') + ')').tolist()
+    if sheet_name == 'prestador': return _search_text(df['empresa']).tolist()
+    # Cada data distinta é formatada uma vez só
+    codes, datas = pd.factorize(pd.to_datetime(df['data_servico'], errors='coerce'))
+    datas = np.append(datas.strftime('%d/%m/%Y').to_numpy(dtype=object), 's/ data')[codes]
+    registro = _search_text(df['registro'])
+    return (_search_text(df['nome_servico']) + ' - ' + datas + registro.where(registro == '', ' (' + registro + ')')).tolist()
+
+# Tokens de cada linha. Saem uma vez por valor distinto da coluna (nomes de serviço e
+# de veículo se repetem muito) e vão para as linhas pelo código do valor
+def _search_docs(sheet_name, df):
+    per_field = []
+    for c in SEARCH_FIELDS[sheet_name]:
+        if c not in df.columns: continue
+        codes, values = pd.factorize(_search_text(df[c]))
+        text = pd.Series(values, dtype=object).str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii').str.lower()
+        tokens = np.empty(len(values), dtype=object)
+        # "BEN-0001" também vira "ben0001", para achar a placa digitada sem o hífen
+        tokens[:] = [frozenset(words + [''.join(words)] if len(words) > 1 else words)
+                     for words in text.str.findall(r'[a-z0-9]+')]
+        per_field.append(tokens[codes])
+    return [set().union(*sets) for sets in zip(*per_field)] if per_field else [set() for _ in range(len(df))]
+
+class SearchIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lineages = {}
+        self.docs = {}                                     # (aba, id) -> tokens
+        self.labels = {}                                   # (aba, id) -> texto exibido
+        self.postings = collections.defaultdict(set)       # token -> {(aba, id)}
+        self.vocab = []                                    # tokens, ordenados
+
+    def load(self, sheet_name, df):
+        self.remove(sheet_name, [k[1] for k in self.docs if k[0] == sheet_name])
+        self.add(sheet_name, df)
+
+    def update(self, sheet_name, ids, df):
+        self.remove(sheet_name, ids)
+        self.add(sheet_name, df[df[get_id_col(sheet_name)].isin(ids)])
+
+    def add(self, sheet_name, df):
+        if df.empty: return
+        keys = [(sheet_name, int(id_value)) for id_value in df[get_id_col(sheet_name)].tolist()]
+        self.labels.update(zip(keys, _search_labels(sheet_name, df)))
+        new = []
+        for key, tokens in zip(keys, _search_docs(sheet_name, df)):
+            self.docs[key] = tokens
+            for token in tokens:
+                if token not in self.postings: new.append(token)
+                self.postings[token].add(key)
+        # Uma ordenação só (o vocabulário já ordenado entra como um bloco pronto)
+        if new: self.vocab = sorted(self.vocab + new)
+
+    def remove(self, sheet_name, ids):
+        gone = set()
+        for id_value in ids:
+            key = (sheet_name, int(id_value))
+            self.labels.pop(key, None)
+            for token in self.docs.pop(key, ()):
+                self.postings[token].discard(key)
+                if not self.postings[token]:
+                    del self.postings[token]
+                    gone.add(token)
+        if gone: self.vocab = [t for t in self.vocab if t not in gone]
+
+    # Registros com todos os termos da consulta (cada termo como prefixo de algum token),
+    # na ordem de SEARCH_FIELDS e dos mais novos para os mais antigos
+    def search(self, query, sheets=None, limit=20):
+        terms = set(_search_tokens(query))
+        if not terms: return []
+        result = None
+        for term in terms:
+            lo = bisect.bisect_left(self.vocab, term)
+            hi = bisect.bisect_left(self.vocab, term + '\x7f')
+            hits = set().union(*(self.postings[t] for t in self.vocab[lo:hi]))
+            result = hits if result is None else result & hits
+            if not result: return []
+        # Quem tem os termos como palavras inteiras vem antes de quem só os tem como prefixo
+        order = {name: i for i, name in enumerate(SEARCH_FIELDS)}
+        keys = sorted((k for k in result if sheets is None or k[0] in sheets),
+                      key=lambda k: (order[k[0]], not terms <= self.docs[k], -k[1]))
+        return [(k[0], k[1], self.labels[k]) for k in keys[:limit]]
+
+    # Os primeiros registros da aba, para o seletor antes de qualquer termo digitado
+    def browse(self, sheet_name, limit):
+        keys = (k for k in self.labels if k[0] == sheet_name)
+        return [(k[0], k[1], self.labels[k]) for k in itertools.islice(keys, limit)]
+
+def get_search_index():
+    return tenant_resource('busca', SearchIndex)
+
+# Só as abas consultadas: as outras ficam como estão até alguém buscar nelas
+def _refresh_search_index(index, sheets=None):
+    snapshot = get_sheets_snapshot(tuple(name for name in SEARCH_FIELDS if sheets is None or name in sheets))
+    for name, (df, lineage) in snapshot.items():
+        old = index.lineages.get(name)
+        if old is not None and _extends(old, lineage):
+            new_jobs = lineage[1][len(old[1]):]
+            get_metrics().cache('busca', 'patch' if new_jobs else 'hit')
+            if new_jobs: index.update(name, {int(id_value) for _, (_, id_value, _) in new_jobs}, df)
+        else:
+            get_metrics().cache('busca', 'miss')
+            index.load(name, df)
+        index.lineages[name] = lineage
+
+def search_records(query, sheets=None, limit=20):
+    index = get_search_index()
+    with timed('busca'), index.lock:
+        _refresh_search_index(index, sheets)
+        return index.search(query, sheets, limit)
+
+def browse_records(sheet_name, limit):
+    index = get_search_index()
+    with index.lock:
+        _refresh_search_index(index, [sheet_name])
+        return index.browse(sheet_name, limit)
+
+def record_label(sheet_name, id_value):
+    index = get_search_index()
+    with index.lock:
+        _refresh_search_index(index, [sheet_name])
+        return index.labels.get((sheet_name, int(id_value)))
 
 # ==============================================================================
 # 4. INTERFACES (FUNÇÕES BLINDADAS)
 # ==============================================================================
 
+# 🟢 0. LISTAGEM PAGINADA (comum às três abas de gestão)
+PAGE_SIZES = [10, 25, 50, 100]
+
+def _sort_key(col):
+    return col.astype(str).str.lower() if col.dtype == object or isinstance(col.dtype, pd.CategoricalDtype) else col
+
+def paginate_frame(df, search, search_cols, sort_col, ascending, page, page_size):
+    if search:
+        mask = np.zeros(len(df), dtype=bool)
+        for col in search_cols:
+            if col in df.columns:
+                mask |= df[col].astype(str).str.contains(search, case=False, regex=False, na=False).to_numpy()
+        df = df[mask]
+    if sort_col in df.columns:
+        df = df.sort_values(sort_col, ascending=ascending, kind='stable', key=_sort_key)
+    n_pages = max(1, -(-len(df) // page_size))
+    page = min(max(page, 1), n_pages)
+    return df.iloc[(page - 1) * page_size: page * page_size], len(df), page, n_pages
+
+# Fragmento: busca, paginação e exclusão reexecutam só a lista, não a página inteira
+@st.fragment
+def entity_list(sheet_name, state_key, key, label_fn, search_cols, sort_options, empty_msg):
+    df = get_sheet_data(sheet_name)
+    if df.empty:
+        st.warning(empty_msg)
+        return
+
+    page_key = f"{key}_pagina"
+    def reset_page(): st.session_state[page_key] = 1
+
+    c_busca, c_ordem, c_tam = st.columns([0.5, 0.3, 0.2])
+    busca = c_busca.text_input("🔎 Buscar", key=f"{key}_busca", on_change=reset_page)
+    ordem = c_ordem.selectbox("Ordenar por", list(sort_options), key=f"{key}_ordem", on_change=reset_page)
+    tamanho = c_tam.selectbox("Por página", PAGE_SIZES, key=f"{key}_tamanho", on_change=reset_page)
+
+    sort_col, ascending = sort_options[ordem]
+    page_df, total, page, n_pages = paginate_frame(
+        df, busca.strip(), search_cols, sort_col, ascending, st.session_state.get(page_key, 1), tamanho
+    )
+    st.session_state[page_key] = page
+
+    if page_df.empty:
+        st.info("Nenhum registro corresponde à busca.")
+    id_col = get_id_col(sheet_name)
+    for row in page_df.to_dict('records'):
+        c1, c2, c3 = st.columns([0.7, 0.15, 0.15])
+        c1.write(label_fn(row))
+        sid = int(row.get(id_col, 0))
+
+        if c2.button("✏️", key=f"btn_ed_{key}_{sid}"):
+            st.session_state[state_key] = sid
+            st.rerun()
+        # Callback: a exclusão entra antes de a lista ser redesenhada, sem rerun extra
+        c3.button("🗑️", key=f"btn_del_{key}_{sid}", on_click=_delete_entity, args=(sheet_name, sid))
+
+    def go_to(target): st.session_state[page_key] = target
+    c_prev, c_info, c_next = st.columns([0.15, 0.7, 0.15])
+    c_prev.button("◀", key=f"{key}_anterior", disabled=page <= 1, on_click=go_to, args=(page - 1,))
+    c_info.caption(f"Página {page} de {n_pages} · {total} registro(s)")
+    c_next.button("▶", key=f"{key}_proxima", disabled=page >= n_pages, on_click=go_to, args=(page + 1,))
+
+# 🟢 BUSCA (seletor com filtro e busca global, ambos pelo índice de busca)
+PICKER_LIMIT = 50
+SEARCH_TARGETS = {'veiculo': ("🚗", "Veículo", 'edit_veiculo_id'), 'prestador': ("🏢", "Prestador", 'edit_prestador_id'),
+                  'servico': ("🔧", "Serviço", 'edit_servico_id')}
+
+# Seletor de registro: a lista traz só os PICKER_LIMIT primeiros resultados do filtro,
+# com o registro atual à frente. Devolve o id escolhido (ou None).
+def record_picker(label, sheet_name, current_id, key):
+    termo = st.text_input(f"🔎 {label}", key=f"{key}_busca", placeholder="Digite para filtrar").strip()
+    found = search_records(termo, (sheet_name,), PICKER_LIMIT) if termo else browse_records(sheet_name, PICKER_LIMIT)
+    labels = {id_value: text for _, id_value, text in found}
+    current = record_label(sheet_name, current_id) if current_id else None
+    if current and not termo: labels = {current_id: current, **labels}
+    if not labels:
+        st.selectbox(label, ["Nenhum registro encontrado"], disabled=True, key=f"{key}_vazio")
+        return None
+    return st.selectbox(label, list(labels), format_func=labels.get, key=f"{key}_sel")
+
+def _open_record(sheet_name, id_value):
+    _, option, state_key = SEARCH_TARGETS[sheet_name]
+    reset_states()
+    st.session_state.update({'aba': MAIN_TABS[-1][0], 'nav_clean_v12': option, state_key: id_value})
+
+@st.fragment
+def search_panel():
+    termo = st.text_input("🔎 Busca", key="busca_global", placeholder="Serviço, registro, empresa, placa...").strip()
+    if not termo: return
+    results = search_records(termo, limit=10)
+    if not results:
+        st.caption("Nada encontrado.")
+        return
+    for sheet_name, id_value, label in results:
+        c1, c2 = st.columns([0.8, 0.2])
+        c1.write(f"{SEARCH_TARGETS[sheet_name][0]} {label}")
+        if c2.button("✏️", key=f"busca_ed_{sheet_name}_{id_value}"):
+            _open_record(sheet_name, id_value)
+            st.rerun()
+
+def _delete_entity(sheet_name, sid):
+    execute_crud_operation(sheet_name, id_value=sid, operation='delete')
+    st.toast("Excluído!")
+
+def _service_label(row):
+    d = pd.to_datetime(row.get('data_servico'), errors='coerce')
+    d_str = d.strftime('%d/%m/%Y') if pd.notna(d) else ""
+    return f"**{row.get('nome_servico', 'Serviço')}** - {d_str}"
+
+def form_value(curr, key, default):
+    # Campos vazios chegam como NA/NaT (bool(pd.NaT) é True, então não dá para usar "or")
+    value = curr.get(key)
+    return default if value is None or value is pd.NaT or pd.isna(value) or value == '' else value
+
 # 🟢 1. VEÍCULOS
 def vehicle_ui():
     st.subheader("Gestão de Veículos")
@@ -173,29 +2604,17 @@ def vehicle_ui():
             st.session_state[state_key] = 'NEW'
             st.rerun()
         
-        df = get_sheet_data('veiculo')
-        if df.empty:
-            st.warning("Nenhum Veículo encontrado.")
-        else:
-            for _, row in df.iterrows():
-                c1, c2, c3 = st.columns([0.7, 0.15, 0.15])
-                val_display = str(row.get('nome', 'Sem Nome'))
-                c1.write(f"**{val_display}**")
-                sid = int(row.get('id_veiculo', 0))
-                
-                if c2.button("✏️", key=f"btn_ed_veic_{sid}"):
-                    st.session_state[state_key] = sid
-                    st.rerun()
-                
-                if c3.button("🗑️", key=f"btn_del_veic_{sid}"):
-                    with st.spinner("Excluindo..."):
-                        execute_crud_operation('veiculo', id_value=sid, operation='delete')
-                    st.success("Excluído!")
-                    time.sleep(1)
-                    st.rerun()
+        entity_list(
+            'veiculo', state_key, 'veic',
+            label_fn=lambda r: f"**{r.get('nome', 'Sem Nome')}**",
+            search_cols=['nome', 'placa'],
+            sort_options={"Nome (A-Z)": ('nome', True), "Mais recentes": ('id_veiculo', False), "Ano": ('ano', False)},
+            empty_msg="Nenhum Veículo encontrado.",
+        )
     else:
         df = get_sheet_data('veiculo')
         is_new = st.session_state[state_key] == 'NEW'
+        if is_new: get_id_allocator().prefetch('veiculo')
         curr = {}
         if not is_new:
             res = df[df['id_veiculo'] == st.session_state[state_key]]
@@ -206,11 +2625,10 @@ def vehicle_ui():
             nome = st.text_input("Nome do Veículo (Obrigatório)*", value=curr.get('nome', ''))
             placa = st.text_input("Placa", value=curr.get('placa', ''))
             c1, c2 = st.columns(2)
-            ano = c1.number_input("Ano", value=int(curr.get('ano', 2020)), step=1, format="%d")
-            valor = c2.number_input("Valor Pago (R$)", value=float(curr.get('valor_pago', 0.0)), format="%.2f")
+            ano = c1.number_input("Ano", value=int(form_value(curr, 'ano', 2020)), step=1, format="%d")
+            valor = c2.number_input("Valor Pago (R$)", value=float(form_value(curr, 'valor_pago', 0.0)), format="%.2f")
             
-            try: d_val = pd.to_datetime(curr.get('data_compra')) if curr.get('data_compra') else date.today()
-            except: d_val = date.today()
+            d_val = form_value(curr, 'data_compra', date.today())
             data_c = st.date_input("Data de Compra", value=d_val, format="DD/MM/YYYY")
             
             if st.form_submit_button("💾 Salvar Veículo"):
@@ -224,12 +2642,10 @@ def vehicle_ui():
                         'valor_pago': float(valor),
                         'data_compra': data_c.strftime('%Y-%m-%d')
                     }
-                    with st.spinner("Salvando..."):
-                        if is_new: execute_crud_operation('veiculo', data=payload, operation='insert')
-                        else: execute_crud_operation('veiculo', data=payload, id_value=st.session_state[state_key], operation='update')
+                    if is_new: execute_crud_operation('veiculo', data=payload, operation='insert')
+                    else: execute_crud_operation('veiculo', data=payload, id_value=st.session_state[state_key], operation='update')
                     st.session_state[state_key] = None
-                    st.success("Salvo!")
-                    time.sleep(0.5)
+                    st.toast("Salvo!")
                     st.rerun()
         if st.button("Cancelar"):
             st.session_state[state_key] = None
@@ -246,27 +2662,17 @@ def provider_ui():
             st.session_state[state_key] = 'NEW'
             st.rerun()
         
-        df = get_sheet_data('prestador')
-        if df.empty:
-            st.warning("Nenhum prestador encontrado.")
-        else:
-            for _, row in df.iterrows():
-                c1, c2, c3 = st.columns([0.7, 0.15, 0.15])
-                c1.write(f"**{row.get('empresa', 'Sem Nome')}**")
-                sid = int(row.get('id_prestador', 0))
-                
-                if c2.button("✏️", key=f"btn_edit_prest_{sid}"):
-                    st.session_state[state_key] = sid
-                    st.rerun()
-                if c3.button("🗑️", key=f"btn_del_prest_{sid}"):
-                    with st.spinner("Excluindo..."):
-                        execute_crud_operation('prestador', id_value=sid, operation='delete')
-                    st.success("Excluído!")
-                    time.sleep(1)
-                    st.rerun()
+        entity_list(
+            'prestador', state_key, 'prest',
+            label_fn=lambda r: f"**{r.get('empresa', 'Sem Nome')}**",
+            search_cols=['empresa', 'nome_prestador', 'cnpj', 'cidade'],
+            sort_options={"Empresa (A-Z)": ('empresa', True), "Mais recentes": ('id_prestador', False), "Cidade": ('cidade', True)},
+            empty_msg="Nenhum prestador encontrado.",
+        )
     else:
         df = get_sheet_data('prestador')
         is_new = st.session_state[state_key] == 'NEW'
+        if is_new: get_id_allocator().prefetch('prestador')
         curr = {}
         if not is_new:
             res = df[df['id_prestador'] == st.session_state[state_key]]
@@ -281,14 +2687,20 @@ def provider_ui():
         input_cep = c_cep.text_input("CEP:", value=str(curr.get('cep', '')), key="input_cep_search")
         
         if c_btn.button("🔍 Buscar CEP"):
-            data_cep = consultar_cep(input_cep)
-            if data_cep:
-                st.session_state.prov_end = data_cep.get('logradouro', '')
-                st.session_state.prov_bai = data_cep.get('bairro', '')
-                st.session_state.prov_cid = data_cep.get('localidade', '')
-                st.success("Endereço encontrado!")
+            if normalize_cep(input_cep) is None:
+                st.error("CEP inválido: informe os 8 dígitos.")
             else:
-                st.error("CEP não encontrado.")
+                try:
+                    data_cep = consultar_cep(input_cep)
+                    if data_cep:
+                        st.session_state.prov_end = data_cep.get('logradouro', '')
+                        st.session_state.prov_bai = data_cep.get('bairro', '')
+                        st.session_state.prov_cid = data_cep.get('localidade', '')
+                        st.success("Endereço encontrado!")
+                    else:
+                        st.error("CEP não encontrado.")
+                except CepLookupError as e:
+                    st.error(str(e))
 
         with st.form("form_prestador_manual"):
             st.markdown("##### 🏢 Dados da Empresa")
@@ -324,15 +2736,13 @@ def provider_ui():
                         'bairro': val_bai
                     }
                     
-                    with st.spinner("Processando..."):
-                        if is_new: execute_crud_operation('prestador', data=payload, operation='insert')
-                        else: execute_crud_operation('prestador', data=payload, id_value=st.session_state[state_key], operation='update')
+                    if is_new: execute_crud_operation('prestador', data=payload, operation='insert')
+                    else: execute_crud_operation('prestador', data=payload, id_value=st.session_state[state_key], operation='update')
                     
                     st.session_state[state_key] = None
                     for k in ['prov_end', 'prov_bai', 'prov_cid']: 
                         if k in st.session_state: del st.session_state[k]
-                    st.success("Salvo com sucesso!")
-                    time.sleep(0.5)
+                    st.toast("Salvo com sucesso!")
                     st.rerun()
 
         if st.button("Cancelar"):
@@ -344,46 +2754,27 @@ def service_ui():
     st.subheader("Gestão de Serviços")
     state_key = 'edit_servico_id'
     
-    df_v = get_sheet_data('veiculo')
-    df_p = get_sheet_data('prestador')
-    df_serv = get_sheet_data('servico')
-    
-    map_v = {f"{r['nome']} ({r.get('placa','S/P')})": int(r['id_veiculo']) for _, r in df_v.iterrows()} if not df_v.empty else {}
-    map_p = {f"{r['empresa']}": int(r['id_prestador']) for _, r in df_p.iterrows()} if not df_p.empty else {}
+    df_v, df_p, df_serv = get_all_sheet_data()
     
     if st.session_state[state_key] is None:
         c_btn, _ = st.columns([0.3, 0.7])
         if c_btn.button("➕ Novo Serviço"):
-            if not map_v or not map_p:
+            if df_v.empty or df_p.empty:
                 st.error("Cadastre Veículos e Prestadores antes de criar um serviço.")
             else:
                 st.session_state[state_key] = 'NEW'
                 st.rerun()
         
-        if not df_serv.empty:
-            if 'data_servico' in df_serv.columns:
-                df_serv['data_servico_dt'] = pd.to_datetime(df_serv['data_servico'], errors='coerce')
-            
-            for _, row in df_serv.iterrows():
-                c1, c2, c3 = st.columns([0.7, 0.15, 0.15])
-                d_str = row['data_servico_dt'].strftime('%d/%m/%Y') if pd.notna(row.get('data_servico_dt')) else ""
-                val_display = str(row.get('nome_servico', 'Serviço'))
-                c1.write(f"**{val_display}** - {d_str}")
-                sid = int(row.get('id_servico', 0))
-                
-                if c2.button("✏️", key=f"btn_ed_s_{sid}"):
-                    st.session_state[state_key] = sid
-                    st.rerun()
-                if c3.button("🗑️", key=f"btn_del_s_{sid}"):
-                    with st.spinner("Apagando..."):
-                        execute_crud_operation('servico', id_value=sid, operation='delete')
-                    st.success("Apagado!")
-                    time.sleep(1)
-                    st.rerun()
-        else:
-            st.info("Nenhum serviço registrado.")
+        entity_list(
+            'servico', state_key, 's',
+            label_fn=_service_label,
+            search_cols=['nome_servico', 'registro'],
+            sort_options={"Data (recentes)": ('data_servico', False), "Data (antigos)": ('data_servico', True), "Valor": ('valor', False)},
+            empty_msg="Nenhum serviço registrado.",
+        )
     else:
         is_new = st.session_state[state_key] == 'NEW'
+        if is_new: get_id_allocator().prefetch('servico')
         curr = {}
         curr_id_v = 0
         curr_id_p = 0
@@ -395,67 +2786,97 @@ def service_ui():
                 curr_id_v = int(curr.get('id_veiculo', 0))
                 curr_id_p = int(curr.get('id_prestador', 0))
 
+        # Fora do form: o filtro dos seletores precisa reexecutar ao digitar
+        picker_key = f"s_{st.session_state[state_key]}"
+        id_v = record_picker("Veículo", 'veiculo', curr_id_v, key=f"{picker_key}_veic")
+        id_p = record_picker("Prestador", 'prestador', curr_id_p, key=f"{picker_key}_prest")
+
         with st.form("form_servico"):
-            idx_v = 0
-            if curr_id_v in map_v.values(): idx_v = list(map_v.values()).index(curr_id_v)
-            idx_p = 0
-            if curr_id_p in map_p.values(): idx_p = list(map_p.values()).index(curr_id_p)
-            
-            opts_v = list(map_v.keys()) if map_v else ["Sem Veículos"]
-            opts_p = list(map_p.keys()) if map_p else ["Sem Prestadores"]
-            
-            sel_v = st.selectbox("Veículo", options=opts_v, index=min(idx_v, len(opts_v)-1))
-            sel_p = st.selectbox("Prestador", options=opts_p, index=min(idx_p, len(opts_p)-1))
-            
             nome_s = st.text_input("Descrição do Serviço (Obrigatório)*", value=curr.get('nome_servico', ''))
             
             c1, c2 = st.columns(2)
-            try: d_val = pd.to_datetime(curr.get('data_servico')) if curr.get('data_servico') else date.today()
-            except: d_val = date.today()
+            d_val = form_value(curr, 'data_servico', date.today())
             
             data_s = c1.date_input("Data", value=d_val, format="DD/MM/YYYY")
-            garantia = c2.number_input("Garantia (dias)", value=int(curr.get('garantia_dias', 90)))
+            garantia = c2.number_input("Garantia (dias)", value=int(form_value(curr, 'garantia_dias', 90)))
             
             c3, c4 = st.columns(2)
-            valor = c3.number_input("Valor R$ (Obrigatório)*", value=float(curr.get('valor', 0.0)), format="%.2f")
-            km_r = c4.number_input("KM Atual", value=int(float(curr.get('km_realizado', 0))), step=1, format="%d")
+            valor = c3.number_input("Valor R$ (Obrigatório)*", value=float(form_value(curr, 'valor', 0.0)), format="%.2f")
+            km_r = c4.number_input("KM Atual", value=int(form_value(curr, 'km_realizado', 0)), step=1, format="%d")
             
-            reg = st.text_input("Nota/Registro", value=curr.get('registro', ''))
+            c5, c6 = st.columns(2)
+            reg = c5.text_input("Nota/Registro", value=curr.get('registro', ''))
+            km_prox = c6.number_input("KM Próxima Revisão (0 = sem)", value=int(form_value(curr, 'km_proxima_revisao', 0)), step=1, format="%d")
             
             if st.form_submit_button("💾 Salvar Serviço"):
-                if not map_v or not map_p:
+                if not id_v or not id_p:
                     st.error("Não é possível salvar sem Veículo/Prestador.")
                 elif not nome_s or nome_s.strip() == "":
                     st.error("❌ Erro: A Descrição do Serviço é obrigatória!")
                 elif valor <= 0:
                     st.error("❌ Erro: O Valor deve ser maior que zero.")
+                elif km_prox and km_prox <= km_r:
+                    st.error("❌ Erro: A KM da próxima revisão deve ser maior que a KM atual.")
                 else:
                     dt_venc = data_s + timedelta(days=int(garantia))
                     payload = {
-                        'id_veiculo': map_v.get(sel_v, 0),
-                        'id_prestador': map_p.get(sel_p, 0),
+                        'id_veiculo': id_v,
+                        'id_prestador': id_p,
                         'nome_servico': nome_s,
                         'data_servico': data_s.strftime('%Y-%m-%d'),
                         'garantia_dias': int(garantia),
                         'valor': float(valor),
                         'km_realizado': int(km_r),
+                        'km_proxima_revisao': int(km_prox) if km_prox else "",
                         'registro': reg,
                         'data_vencimento': dt_venc.strftime('%Y-%m-%d')
                     }
                     
-                    with st.spinner("Salvando..."):
-                        if is_new: execute_crud_operation('servico', data=payload, operation='insert')
-                        else: execute_crud_operation('servico', data=payload, id_value=st.session_state[state_key], operation='update')
+                    if is_new: execute_crud_operation('servico', data=payload, operation='insert')
+                    else: execute_crud_operation('servico', data=payload, id_value=st.session_state[state_key], operation='update')
                     
                     st.session_state[state_key] = None
-                    st.success("Serviço Salvo!")
-                    time.sleep(0.5)
+                    st.toast("Serviço Salvo!")
                     st.rerun()
 
         if st.button("Cancelar"):
             st.session_state[state_key] = None
             st.rerun()
 
+# 🟢 4. IMPORTAÇÃO EM LOTE
+IMPORT_TARGETS = {"Serviços": 'servico', "Veículos": 'veiculo', "Prestadores": 'prestador'}
+
+def import_ui():
+    st.subheader("Importação em Lote")
+    alvo = st.selectbox("Importar para:", list(IMPORT_TARGETS), key="imp_alvo")
+    sheet_name = IMPORT_TARGETS[alvo]
+    cols = [c for c in EXPECTED_COLS[sheet_name] if c != get_id_col(sheet_name)]
+    st.caption(f"Colunas: {', '.join(cols)}" + (" — em vez dos ids, pode usar 'veiculo' (nome ou placa) e 'prestador' (empresa)." if sheet_name == 'servico' else ""))
+    upload = st.file_uploader("Arquivo CSV ou XLSX", type=['csv', 'xlsx'], key="imp_arquivo")
+    if upload is None: return
+
+    c1, c2 = st.columns(2)
+    validar = c1.button("🔎 Validar")
+    importar = c2.button("📥 Importar", type="primary")
+    if not (validar or importar): return
+
+    try:
+        bar = st.progress(0.0) if importar else None
+        n_valid, errors, n_saved = import_records(sheet_name, upload, dry_run=validar, progress=bar.progress if bar else None)
+    except (ValueError, SheetReadError, ConflictError) as e:
+        st.error(f"❌ {e}")
+        return
+
+    if errors:
+        st.error(f"❌ {len(errors)} linha(s) com problema{' (mostrando as primeiras)' if len(errors) >= IMPORT_MAX_ERRORS else ''}. Nada foi gravado.")
+        st.dataframe(pd.DataFrame(errors), hide_index=True, use_container_width=True)
+    elif n_saved:
+        st.success(f"✅ {n_saved} registro(s) importado(s).")
+    elif n_valid:
+        st.success(f"✅ {n_valid} linha(s) válida(s), prontas para importar.")
+    else:
+        st.warning("Arquivo sem linhas.")
+
 # ==============================================================================
 # 5. MAIN (COM RESET DE ESTADO)
 # ==============================================================================
@@ -467,12 +2888,27 @@ def reset_states():
     st.session_state['edit_prestador_id'] = None
     st.session_state['edit_servico_id'] = None
 
+# Troca de frota: edições abertas, filtros e posições guardadas eram da planilha anterior
+def _switch_tenant():
+    for key in list(st.session_state):
+        if key != 'frota': del st.session_state[key]
+    st.query_params['frota'] = st.session_state['frota']
+
+# Com mais de uma frota configurada, a sessão escolhe a sua (a primeira vez, pela URL)
+def select_tenant():
+    if len(TENANTS) == 1: return
+    if 'frota' not in st.session_state:
+        requested = st.query_params.get('frota', next(iter(TENANTS)))
+        if requested not in TENANTS:
+            st.error(f"❌ Frota desconhecida: {requested}")
+            st.stop()
+        st.session_state['frota'] = requested
+    st.sidebar.selectbox("🚚 Frota", list(TENANTS), key='frota', on_change=_switch_tenant)
+
 def run_auto_test_data():
     st.info("Simulando...")
     execute_crud_operation('veiculo', data={'nome': 'Civic Teste', 'placa': 'TST-0001', 'ano': 2023, 'valor_pago': 150000, 'data_compra': '2023-01-01'}, operation='insert')
     execute_crud_operation('prestador', data={'empresa': 'Oficina Master', 'telefone': 1199999, 'cnpj': '00.000/0001-00'}, operation='insert')
-    time.sleep(1)
-    st.cache_data.clear()
     
     df_v = get_sheet_data('veiculo')
     df_p = get_sheet_data('prestador')
@@ -493,55 +2929,56 @@ def run_auto_test_data():
             'garantia_dias': 180, 'valor': 500.0, 'km_realizado': 10000, 'registro': 'TEST-99', 
             'data_vencimento': (date.today() + timedelta(days=180)).strftime('%Y-%m-%d')
         }, operation='insert')
-        st.success("Dados criados!")
-        time.sleep(1)
+        st.toast("Dados criados!")
         st.rerun()
 
-def main():
-    st.set_page_config(page_title="Controle Automotivo", layout="wide")
-    for key in ['edit_veiculo_id', 'edit_prestador_id', 'edit_servico_id']:
-        if key not in st.session_state: st.session_state[key] = None
-
-    st.title("🚗 Sistema de Controle Automotivo")
-    
-    tab_resumo, tab_hist, tab_manual = st.tabs(["📊 Resumo", "📈 Histórico", "➕ Manual de Gestão"])
-
-    with st.sidebar:
-        st.header("⚙️ Ferramentas")
-        if st.button("🔄 Atualizar Dados"):
-            st.cache_data.clear()
+# Onde foi o tempo desde o início do processo (ou o último "Zerar"): API, caches e abas
+def debug_panel():
+    with st.expander("🐞 Desempenho"):
+        metrics = get_metrics()
+        snap = metrics.snapshot()
+        if snap['caches']:
+            st.caption("Caches")
+            st.dataframe(pd.DataFrame(snap['caches']).fillna(0), hide_index=True, use_container_width=True)
+        if snap['tempos']:
+            st.caption("Tempos")
+            df_t = pd.DataFrame(snap['tempos']).sort_values('total_ms', ascending=False)
+            st.dataframe(df_t, hide_index=True, use_container_width=True)
+        if len(TENANTS) > 1:
+            st.caption("Frotas em memória")
+            names = {key: name for name, key in TENANTS.items()}
+            usage = get_tenant_store().usage()
+            st.dataframe(pd.DataFrame({'frota': [names.get(t, t) for t in usage], 'mb': [round(n / 2 ** 20, 1) for n in usage.values()]}),
+                         hide_index=True, use_container_width=True)
+        c1, c2 = st.columns(2)
+        c1.download_button("⬇️ Exportar", json.dumps(snap, indent=2), file_name="metricas.json", mime="application/json")
+        if c2.button("Zerar", key="metrics_reset"):
+            metrics.reset()
             st.rerun()
-        if st.button("🧪 Rodar Simulação"): run_auto_test_data()
 
-    # ABA RESUMO
-    with tab_resumo:
-        df_full = get_full_service_data()
+# 🟢 ABAS PRINCIPAIS (cada uma é um fragmento: seus widgets reexecutam só a própria aba)
+@st.fragment
+def summary_tab():
+    with timed('aba_resumo'):
+        cube = get_spend_cube()
         
-        if not df_full.empty:
-            df_full['Ano'] = df_full['data_servico'].dt.year
-            
+        if cube is not None:
             st.subheader("Filtros")
             c1, c2 = st.columns(2)
             
-            anos = sorted(df_full['Ano'].dropna().unique().astype(int).tolist(), reverse=True)
-            sel_ano = c1.selectbox("Ano", ["Todos"] + anos)
-            
-            veiculos = sorted(df_full['nome'].astype(str).unique().tolist())
-            sel_veiculo = c2.selectbox("Veículo", ["Todos"] + veiculos)
+            sel_ano = c1.selectbox("Ano", ["Todos"] + cube['anos'], key="r_ano")
+            sel_veiculo = c2.selectbox("Veículo", ["Todos"] + cube['veiculos'], key="r_veiculo")
             
-            df_filt = df_full.copy()
-            if sel_ano != "Todos": df_filt = df_filt[df_filt['Ano'] == sel_ano]
-            if sel_veiculo != "Todos": df_filt = df_filt[df_filt['nome'] == sel_veiculo]
+            total, n_servicos, df_chart = spend_lookup(cube, sel_ano, sel_veiculo)
             
             st.divider()
             
-            if not df_filt.empty:
+            if n_servicos:
                 k1, k2 = st.columns(2)
-                k1.metric("Total Gasto", f"R$ {df_filt['valor'].sum():,.2f}")
-                k2.metric("Serviços", len(df_filt))
+                k1.metric("Total Gasto", f"R$ {total:,.2f}")
+                k2.metric("Serviços", n_servicos)
                 
                 st.subheader("Gastos por Veículo")
-                df_chart = df_filt.groupby('nome', as_index=False)['valor'].sum()
                 
                 base = alt.Chart(df_chart).encode(
                     x=alt.X('nome', sort='-y', title='Veículo'),
@@ -552,40 +2989,203 @@ def main():
                 st.altair_chart((barras + txt).properties(height=400).interactive(), use_container_width=True)
             else:
                 st.warning("Nenhum dado com estes filtros.")
+
+            an = get_analytics()
+            veiculos, tendencia = analytics_lookup(an, sel_ano, sel_veiculo)
+            st.subheader("Custos e Tendências")
+            k1, k2, k3 = st.columns(3)
+            km_total = veiculos['km_rodado'].sum()
+            k1.metric("Custo por km (histórico)", f"R$ {veiculos['gasto'].sum() / km_total:,.2f}" if km_total else "-")
+            k2.metric("Gasto nos últimos 12 meses", f"R$ {veiculos['gasto_12m'].sum():,.2f}")
+            k3.metric(f"Projeção {an['hoje'].year}", f"R$ {veiculos['projecao_ano'].sum():,.2f}")
+
+            if not tendencia.empty:
+                x = alt.X('yearmonth(mes):T', title='Mês')
+                barras = alt.Chart(tendencia).mark_bar(color='#FF4B4B', opacity=0.6).encode(x=x, y=alt.Y('mensal:Q', title='Gasto no mês (R$)'))
+                linha = alt.Chart(tendencia).mark_line(color='#1F77B4').encode(x=x, y=alt.Y('movel_12m:Q', title='12 meses móveis (R$)'))
+                st.altair_chart(alt.layer(barras, linha).resolve_scale(y='independent').properties(height=300), use_container_width=True)
+
+            c1, c2 = st.columns(2)
+            pizza = alt.Chart(provider_share(an)).mark_arc(innerRadius=50).encode(
+                theta='participacao:Q', color=alt.Color('empresa:N', sort=None, title='Prestador'),
+                tooltip=['empresa:N', alt.Tooltip('participacao:Q', format='.1%')],
+            )
+            c1.caption("Participação dos prestadores")
+            c1.altair_chart(pizza.properties(height=300), use_container_width=True)
+            custo_km = veiculos['custo_km'].dropna().nlargest(15).rename_axis('nome').reset_index()
+            c2.caption("Custo por km (maiores)")
+            if not custo_km.empty:
+                c2.altair_chart(alt.Chart(custo_km).mark_bar(color='#FF4B4B').encode(
+                    x=alt.X('nome:N', sort='-y', title='Veículo'), y=alt.Y('custo_km:Q', title='R$/km'),
+                ).properties(height=300), use_container_width=True)
+            else:
+                c2.info("Sem leituras de KM suficientes.")
         else:
             st.info("Nenhum serviço registrado para o resumo.")
 
-    # ABA HISTÓRICO
-    with tab_hist:
-        df_full = get_full_service_data()
+@st.fragment
+def history_tab():
+    with timed('aba_hist'):
+        df_full, version = _service_view_snapshot()
         if not df_full.empty:
-            df_full['Ano'] = df_full['data_servico'].dt.year
-            c1, c2 = st.columns(2)
-            
-            v_sel = c1.selectbox("Filtrar Veículo:", ["Todos"] + sorted(list(df_full['nome'].astype(str).unique())), key="h_v")
-            y_sel = c2.selectbox("Filtrar Ano:", ["Todos"] + sorted(list(df_full['Ano'].dropna().unique().astype(int))), key="h_y")
-            
-            df_filt = df_full.copy()
-            if v_sel != "Todos": df_filt = df_filt[df_filt['nome'] == v_sel]
-            if y_sel != "Todos": df_filt = df_filt[df_filt['Ano'] == y_sel]
-            
-            cols_view = ['nome', 'placa', 'nome_servico', 'empresa', 'data_servico', 'valor', 'Dias p/ Vencer']
-            df_view = df_filt[cols_view].copy()
-            if 'data_servico' in df_view.columns:
-                df_view['data_servico'] = df_view['data_servico'].dt.strftime('%d/%m/%Y')
-                
-            st.dataframe(df_view, use_container_width=True)
+            cube = get_spend_cube()
+            def reset_page(): st.session_state['h_pagina'] = 1
+            c1, c2, c3 = st.columns(3)
+            v_sel = c1.selectbox("Filtrar Veículo:", ["Todos"] + cube['veiculos'], key="h_v", on_change=reset_page)
+            y_sel = c2.selectbox("Filtrar Ano:", ["Todos"] + sorted(cube['anos']), key="h_y", on_change=reset_page)
+            busca = c3.text_input("🔎 Serviço ou registro", key="h_busca", on_change=reset_page).strip()
+            c4, c5 = st.columns(2)
+            ordem = c4.selectbox("Ordenar por", list(HIST_SORTS), key="h_ordem", on_change=reset_page)
+            tamanho = c5.selectbox("Por página", PAGE_SIZES, key="h_tamanho", on_change=reset_page)
+
+            # Posições filtradas/ordenadas guardadas na sessão: trocar de página não refaz o filtro
+            filtro = (version, v_sel, y_sel, busca, ordem)
+            cached = st.session_state.get('h_posicoes')
+            if cached is None or cached[0] != filtro:
+                ids = [id_value for _, id_value, _ in search_records(busca, ('servico',), None)] if busca else None
+                cached = (filtro, history_positions(df_full, v_sel, y_sel, ids, ordem))
+                st.session_state['h_posicoes'] = cached
+            pos = cached[1]
+
+            n_pages = max(1, -(-len(pos) // tamanho))
+            page = min(max(st.session_state.get('h_pagina', 1), 1), n_pages)
+            st.session_state['h_pagina'] = page
+            janela = df_full.iloc[pos[(page - 1) * tamanho: page * tamanho]]
+
+            # Só a janela vai para o navegador; datas e valores são formatados pelo column_config
+            cols_view = ['nome', 'placa', 'nome_servico', 'empresa', 'data_servico', 'valor', 'data_vencimento', 'Dias p/ Vencer']
+            st.dataframe(with_days_to_due(janela)[cols_view], use_container_width=True, hide_index=True, column_config=HIST_COLUMNS)
+
+            def go_to(target): st.session_state['h_pagina'] = target
+            c_prev, c_info, c_next = st.columns([0.15, 0.7, 0.15])
+            c_prev.button("◀", key="h_anterior", disabled=page <= 1, on_click=go_to, args=(page - 1,))
+            c_info.caption(f"Página {page} de {n_pages} · {len(pos)} serviço(s)")
+            c_next.button("▶", key="h_proxima", disabled=page >= n_pages, on_click=go_to, args=(page + 1,))
+
+            # O CSV só é gerado quando pedido, não a cada rerun
+            if st.button("📤 Exportar CSV", key="h_export"):
+                st.session_state['h_export_csv'] = (filtro, export_csv(df_full.iloc[pos]))
+            cached = st.session_state.get('h_export_csv')
+            if cached and cached[0] == filtro:
+                st.download_button("⬇️ Baixar CSV", cached[1], file_name="historico_servicos.csv", mime="text/csv", key="h_download")
         else:
             st.info("Histórico vazio.")
 
-    # ABA MANUAL
-    with tab_manual:
+HIST_COLUMNS = {
+    'nome': "Veículo", 'placa': "Placa", 'nome_servico': "Serviço", 'empresa': "Prestador",
+    'data_servico': st.column_config.DateColumn("Data", format="DD/MM/YYYY"),
+    'valor': st.column_config.NumberColumn("Valor", format="R$ %.2f"),
+    'data_vencimento': st.column_config.DateColumn("Vencimento", format="DD/MM/YYYY"),
+    'Dias p/ Vencer': st.column_config.NumberColumn("Dias p/ Vencer", format="%d"),
+}
+
+@st.fragment
+def alerts_tab():
+    with timed('aba_alertas'):
+        c1, c2 = st.columns(2)
+        dias = c1.number_input("Garantias vencendo nos próximos (dias)", min_value=0, value=30, step=5, key="al_dias")
+        km = c2.number_input("Veículos a até (km) da próxima revisão", min_value=0, value=1000, step=500, key="al_km")
+        expiring, near = maintenance_alerts(int(dias), int(km))
+
+        st.subheader(f"🛡️ Garantias vencendo ({len(expiring)})")
+        if expiring:
+            days_left = dict(expiring)
+            df_full = get_full_service_data()
+            df_due = df_full[df_full['id_servico'].isin(days_left)]
+            df_due = df_due.assign(**{'Dias p/ Vencer': df_due['id_servico'].map(days_left)}).sort_values('Dias p/ Vencer')
+            df_due = df_due[['nome', 'placa', 'nome_servico', 'empresa', 'data_vencimento', 'Dias p/ Vencer']].copy()
+            df_due['data_vencimento'] = df_due['data_vencimento'].dt.strftime('%d/%m/%Y')
+            st.dataframe(df_due, use_container_width=True, hide_index=True)
+        else:
+            st.success("Nenhuma garantia vence no período.")
+
+        st.subheader(f"🔧 Revisões próximas ({len(near)})")
+        if near:
+            df_v = get_sheet_data('veiculo').set_index('id_veiculo')
+            df_near = pd.DataFrame(near, columns=['id_veiculo', 'Faltam (km)', 'KM Atual', 'Próxima Revisão'])
+            df_near.insert(1, 'nome', df_near['id_veiculo'].map(df_v['nome']).astype(str))
+            df_near.insert(2, 'placa', df_near['id_veiculo'].map(df_v['placa']).astype(str))
+            st.dataframe(df_near.drop(columns='id_veiculo'), use_container_width=True, hide_index=True)
+            if (df_near['Faltam (km)'] <= 0).any(): st.warning("Há veículos com a revisão atrasada (km restante negativa).")
+        else:
+            st.success("Nenhum veículo perto da próxima revisão.")
+
+@st.fragment
+def manual_tab():
+    with timed('aba_manual'):
         # CORREÇÃO: on_change=reset_states limpa o estado ao trocar a aba
-        opcao = st.radio("Gerenciar:", ["Veículo", "Serviço", "Prestador"], horizontal=True, key="nav_clean_v12", on_change=reset_states)
+        opcao = st.radio("Gerenciar:", ["Veículo", "Serviço", "Prestador", "Importação"], horizontal=True, key="nav_clean_v12", on_change=reset_states)
         st.divider()
         if opcao == "Veículo": vehicle_ui()
         elif opcao == "Serviço": service_ui()
         elif opcao == "Prestador": provider_ui()
+        elif opcao == "Importação": import_ui()
+
+MAIN_TABS = [("📊 Resumo", summary_tab), ("📈 Histórico", history_tab), ("🔔 Alertas", alerts_tab), ("➕ Manual de Gestão", manual_tab)]
+TAB_WIDGET_KEYS = ['r_ano', 'r_veiculo', 'h_v', 'h_y', 'h_busca', 'h_ordem', 'h_tamanho', 'al_dias', 'al_km', 'nav_clean_v12']
+
+# O Streamlit descarta o estado de widgets que não foram desenhados na execução;
+# regravar as chaves mantém os filtros de uma aba enquanto outra está aberta
+def _keep_widget_state(keys):
+    for key in keys:
+        if key in st.session_state: st.session_state[key] = st.session_state[key]
+
+def main():
+    st.set_page_config(page_title="Controle Automotivo", layout="wide")
+    select_tenant()
+    for key in ['edit_veiculo_id', 'edit_prestador_id', 'edit_servico_id']:
+        if key not in st.session_state: st.session_state[key] = None
+
+    st.title("🚗 Sistema de Controle Automotivo")
+
+    warmup = get_warmup()
+    warmup.start()
+    try:
+        get_all_sheet_data()
+    except SheetReadError as e:
+        st.error(f"❌ {e}")
+        if st.button("🔄 Tentar novamente"): st.rerun()
+        st.stop()
+    
+    with st.sidebar:
+        search_panel()
+        st.header("⚙️ Ferramentas")
+        if st.button("🔄 Atualizar Dados"):
+            try:
+                refresh_all_data()
+                st.rerun()
+            except SheetReadError as e:
+                st.warning(f"⚠️ Planilha indisponível, mostrando a cópia local: {e}")
+        if st.button("🧪 Rodar Simulação"): run_auto_test_data()
+        jobs = sync_write_jobs()
+        n_pending = sum(1 for status in jobs.values() if status == 'pending')
+        n_failed = sum(1 for status in jobs.values() if status == 'failed')
+        if n_pending: st.caption(f"⏳ {n_pending} gravação(ões) pendente(s)")
+        if n_failed: st.caption(f"❌ {n_failed} gravação(ões) falharam e foram desfeitas")
+        if st.button("🧹 Compactar Planilhas"):
+            try:
+                with st.spinner("Compactando..."):
+                    compacted = compact_all_sheets()
+                if compacted: st.rerun()
+            except SheetReadError as e:
+                st.error(f"❌ {e}")
+        if st.button("📮 Completar Endereços"):
+            try:
+                with st.spinner("Consultando CEPs..."):
+                    n = backfill_provider_addresses()
+                st.toast(f"{n} prestador(es) atualizado(s).")
+            except SheetReadError as e:
+                st.error(f"❌ {e}")
+
+    # Só a aba escolhida é executada
+    _keep_widget_state(TAB_WIDGET_KEYS)
+    labels = [label for label, _ in MAIN_TABS]
+    aba = st.radio("Aba", labels, horizontal=True, key="aba", label_visibility="collapsed")
+    dict(MAIN_TABS)[aba]()
+
+    with st.sidebar:
+        debug_panel()
+    if 'primeira_tela' not in warmup.phases: warmup.phase('primeira_tela')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,187 @@
+# ==============================================================================
+# Benchmark do app.py contra o cliente gspread em memória (fake_gspread.py).
+#
+#   python benchmark.py                         # 10, 1k, 10k e 100k serviços
+#   python benchmark.py --sizes 10,1000 --latency 80 --quota 300 --json out.json
+#
+# Para cada tamanho de frota mede leitura das abas (fria e em cache), montagem da
+# visão consolidada, análises de custo, inclusão/edição/exclusão (até a gravação
+# terminar) e uma execução completa do main() pelo AppTest, com os caches quentes e
+# partindo do zero como um processo novo (primeira tela servida pelo snapshot). Reporta percentis de
+# latência, chamadas à API por operação e pico de memória (tracemalloc, numa execução extra).
+# ==============================================================================
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+# O app pega o cliente por aqui (ver get_gspread_client)
+os.environ['GSPREAD_CLIENT_FACTORY'] = 'benchmark:current_client'
+CLIENT = None
+
+def current_client():
+    return CLIENT
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def measure(name, fn, repeat, memory=True, setup=None):
+    times, calls, errors = [], [], 0
+    for _ in range(repeat):
+        if setup: setup()
+        before = CLIENT.total_calls()
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except Exception:
+            errors += 1
+        times.append(time.perf_counter() - t0)
+        calls.append(CLIENT.total_calls() - before)
+
+    peak = None
+    if memory:
+        if setup: setup()
+        tracemalloc.start()
+        try: fn()
+        except Exception: pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'path': name, 'n': repeat, 'errors': errors,
+        'p50_ms': percentile(times, 50) * 1000, 'p95_ms': percentile(times, 95) * 1000,
+        'p99_ms': percentile(times, 99) * 1000, 'max_ms': max(times) * 1000,
+        'calls_per_op': sum(calls) / len(calls),
+        'peak_mb': peak / 2 ** 20 if peak is not None else None,
+    }
+
+# Espera o aquecimento em segundo plano terminar, para ele não cair na medição seguinte
+def settle(app):
+    warmup = app.get_warmup()
+    if warmup.warming(): warmup.done.wait()
+
+def run_size(app, st, fake_gspread, n_services, args):
+    global CLIENT
+    st.cache_resource.clear()
+    CLIENT = fake_gspread.make_client(n_services, key=app.DEFAULT_TENANT, latency=args.latency, quota=args.quota, quota_window=args.quota_window)
+    cache = app.get_sheet_cache()
+    write_queue = app.get_write_queue()
+    rnd = random.Random(n_services)
+    results = []
+
+    def bench(name, fn, repeat=args.repeat, setup=None):
+        results.append(dict(measure(name, fn, repeat, not args.no_memory, setup), size=n_services))
+
+    bench('read_sheets_cold', app.get_all_sheet_data, setup=cache.invalidate)
+    bench('read_sheets_cached', app.get_all_sheet_data)
+    bench('full_service_data_build', app.get_full_service_data, setup=lambda: app.get_service_view().release())
+    bench('full_service_data_cached', app.get_full_service_data)
+    bench('analytics_build', lambda: app.build_analytics(app.get_full_service_data()))
+    bench('analytics_cached', app.get_analytics)
+
+    inserted = []
+    def insert():
+        job_id = app.execute_crud_operation('servico', operation='insert', data={
+            'id_veiculo': 1, 'id_prestador': 1, 'nome_servico': 'Benchmark', 'data_servico': '2024-01-01',
+            'garantia_dias': 90, 'valor': 123.45, 'km_realizado': 1000, 'registro': 'bench',
+            'data_vencimento': '2024-03-31',
+        })
+        write_queue.wait_idle()
+        inserted.append(app.get_sheet_data('servico')['id_servico'].max())
+        if job_id is None or write_queue.status(job_id)[0] == 'failed': raise RuntimeError('insert')
+
+    def update():
+        ids = app.get_sheet_data('servico')['id_servico']
+        job_id = app.execute_crud_operation('servico', operation='update', id_value=ids.iloc[rnd.randrange(len(ids))],
+                                            data={'valor': round(rnd.uniform(50, 3000), 2)})
+        write_queue.wait_idle()
+        if job_id is None or write_queue.status(job_id)[0] == 'failed': raise RuntimeError('update')
+
+    def delete():
+        job_id = app.execute_crud_operation('servico', operation='delete', id_value=inserted.pop())
+        write_queue.wait_idle()
+        if job_id is None or write_queue.status(job_id)[0] == 'failed': raise RuntimeError('delete')
+
+    bench('crud_insert', insert)
+    bench('crud_update', update)
+    bench('crud_delete', delete, repeat=min(args.repeat, len(inserted) - (0 if args.no_memory else 1)))
+
+    if not args.no_apptest:
+        from streamlit.testing.v1 import AppTest
+        def apptest():
+            at = AppTest.from_string("import app\napp.main()", default_timeout=args.apptest_timeout).run()
+            if at.exception: raise RuntimeError(at.exception[0].message)
+        bench('apptest_main', apptest, repeat=args.apptest_repeat)
+        # Processo novo (caches de recurso zerados): a primeira tela sai do snapshot em disco
+        def new_process():
+            settle(app)
+            st.cache_resource.clear()
+        bench('apptest_cold_start', apptest, repeat=args.apptest_repeat, setup=new_process)
+        settle(app)
+
+    return results
+
+def print_table(results):
+    cols = ['size', 'path', 'n', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'calls_per_op', 'peak_mb']
+    print(' '.join(f'{c:>26}' if c == 'path' else f'{c:>12}' for c in cols))
+    for r in results:
+        cells = []
+        for c in cols:
+            v = r[c]
+            text = '-' if v is None else f'{v:.1f}' if isinstance(v, float) else str(v)
+            cells.append(f'{text:>26}' if c == 'path' else f'{text:>12}')
+        print(' '.join(cells))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do app contra um gspread em memória")
+    parser.add_argument('--sizes', default='10,1000,10000,100000', help="quantidades de serviços, separadas por vírgula")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--latency', default='0', help="latência por chamada em ms, ou faixa 'min-max'")
+    parser.add_argument('--quota', type=int, default=None, help="máximo de chamadas por janela (padrão: sem limite)")
+    parser.add_argument('--quota-window', type=float, default=60.0)
+    parser.add_argument('--governor', type=int, default=None, help="chamadas/min do governador do app (padrão: sem limite)")
+    parser.add_argument('--no-apptest', action='store_true')
+    parser.add_argument('--apptest-repeat', type=int, default=3)
+    parser.add_argument('--apptest-timeout', type=float, default=600)
+    parser.add_argument('--no-memory', action='store_true', help="não mede pico de memória (tracemalloc)")
+    parser.add_argument('--json', help="grava os resultados neste arquivo")
+    args = parser.parse_args(argv)
+    low, _, high = args.latency.partition('-')
+    args.latency = (float(low) / 1000, float(high) / 1000) if high else float(low) / 1000
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Executado como script, este módulo é __main__: a fábrica precisa achar o mesmo CLIENT
+    sys.modules.setdefault('benchmark', sys.modules[__name__])
+    logging.disable(logging.WARNING)
+    os.environ['SHEETS_QUOTA_PER_MIN'] = str(args.governor or 10 ** 9)
+    # Snapshots do app num diretório só deste benchmark, para não misturar com os de uso real
+    os.environ['SNAPSHOT_DIR'] = tempfile.mkdtemp(prefix='benchmark_snapshot_')
+
+    import streamlit as st
+    import fake_gspread
+    import app
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(',') if s]:
+        t0 = time.perf_counter()
+        results += run_size(app, st, fake_gspread, size, args)
+        print(f"# {size} serviços: {time.perf_counter() - t0:.1f}s, {CLIENT.quota_errors} erro(s) de cota", file=sys.stderr)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
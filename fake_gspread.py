@@ -0,0 +1,300 @@
+# ==============================================================================
+# Cliente gspread em memória, para benchmark e testes locais sem a API do Google.
+# Implementa só o que o app.py usa. Cada chamada é contada em `client.calls`, pode
+# sofrer uma latência artificial e respeita uma cota de chamadas por janela de tempo
+# (estourou a cota -> APIError 429, como a API real).
+# ==============================================================================
+
+import collections
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import date, timedelta
+
+import gspread
+import requests
+from gspread.utils import a1_range_to_grid_range
+
+def _cell(value):
+    if value is None: return ""
+    if isinstance(value, float) and value.is_integer(): return str(int(value))
+    return str(value)
+
+# RowData da API (batchUpdate) -> lista de células como a aba guarda
+def _row_data(row):
+    return [_cell(next(iter(v.get('userEnteredValue', {'stringValue': ''}).values()))) for v in row.get('values', [])]
+
+def api_error(code, message, status):
+    response = requests.Response()
+    response.status_code = code
+    response._content = json.dumps({'error': {'code': code, 'message': message, 'status': status}}).encode()
+    return gspread.exceptions.APIError(response)
+
+def quota_error(message="Quota exceeded for quota metric 'Read requests'"):
+    return api_error(429, message, 'RESOURCE_EXHAUSTED')
+
+class FakeWorksheet:
+    _ids = itertools.count(1)
+
+    def __init__(self, spreadsheet, title, values=None):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = next(self._ids)
+        self.rows = [list(map(_cell, r)) for r in (values or [])]
+        self.row_count = max(len(self.rows), 1000)
+
+    def _call(self, name):
+        self.spreadsheet.client._call(name)
+
+    def _width(self):
+        return max((len(r) for r in self.rows), default=0)
+
+    def _grid(self, range_name):
+        name = range_name.split('!')[-1] if '!' in range_name else range_name
+        if name.strip("'") == self.title:
+            return 0, len(self.rows), 0, self._width()
+        g = a1_range_to_grid_range(name)
+        return (g.get('startRowIndex', 0), g.get('endRowIndex', len(self.rows)),
+                g.get('startColumnIndex', 0), g.get('endColumnIndex', self._width()))
+
+    def _read(self, range_name):
+        r0, r1, c0, c1 = self._grid(range_name)
+        out = [row[c0:c1] for row in self.rows[r0:r1]]
+        while out and not any(out[-1]): out.pop()
+        return [list(r) for r in out]
+
+    def _write(self, r0, c0, values):
+        for i, row in enumerate(values):
+            while len(self.rows) <= r0 + i: self.rows.append([])
+            target = self.rows[r0 + i]
+            for j, v in enumerate(row):
+                while len(target) <= c0 + j: target.append("")
+                target[c0 + j] = _cell(v)
+
+    def get_all_records(self, **kw):
+        self._call('get_all_records')
+        if not self.rows: return []
+        header, width = self.rows[0], len(self.rows[0])
+        return [dict(zip(header, gspread.utils.numericise_all((r + [""] * width)[:width])))
+                for r in self.rows[1:] if any(r)]
+
+    def get_all_values(self, **kw):
+        self._call('get_all_values')
+        return [list(r) for r in self.rows]
+
+    def get(self, range_name=None, **kw):
+        self._call('get')
+        return self._read(range_name or self.title)
+
+    def batch_get(self, ranges, **kw):
+        self._call('batch_get')
+        return [self._read(r) for r in ranges]
+
+    def row_values(self, row, **kw):
+        self._call('row_values')
+        values = list(self.rows[row - 1]) if row <= len(self.rows) else []
+        while values and values[-1] == "": values.pop()
+        return values
+
+    def col_values(self, col, **kw):
+        self._call('col_values')
+        values = [r[col - 1] if len(r) >= col else "" for r in self.rows]
+        while values and values[-1] == "": values.pop()
+        return values
+
+    def update(self, values, range_name=None, **kw):
+        self._call('update')
+        r0, _, c0, _ = self._grid(range_name or 'A1')
+        self._write(r0, c0, values)
+
+    def batch_update(self, data, **kw):
+        self._call('batch_update')
+        for item in data:
+            r0, _, c0, _ = self._grid(item['range'])
+            self._write(r0, c0, item['values'])
+
+    def append_rows(self, values, **kw):
+        self._call('append_rows')
+        with self.spreadsheet.lock:
+            start = self._append([list(map(_cell, r)) for r in values])
+        # Como a API: a resposta diz em que linhas os dados entraram
+        end = gspread.utils.rowcol_to_a1(start + len(values) - 1, max((len(r) for r in values), default=1))
+        return {'updates': {'updatedRange': f"'{self.title}'!A{start}:{end}", 'updatedRows': len(values)}}
+
+    def _append(self, rows):
+        while self.rows and not any(self.rows[-1]): self.rows.pop()
+        self.rows.extend(rows)
+        return len(self.rows) - len(rows) + 1
+
+    def delete_rows(self, start_index, end_index=None, **kw):
+        self._call('delete_rows')
+        del self.rows[start_index - 1:(end_index or start_index)]
+
+    def clear(self):
+        self._call('clear')
+        self.rows = []
+
+    def resize(self, rows=None, cols=None):
+        self._call('resize')
+        if rows is not None:
+            del self.rows[rows:]
+            self.row_count = rows
+
+class FakeSpreadsheet:
+    def __init__(self, client, key, title, sheets=None):
+        self.client = client
+        self.id = key
+        self.title = title
+        self._worksheets = {}
+        self.lock = threading.Lock()
+        for name, values in (sheets or {}).items():
+            self._worksheets[name] = FakeWorksheet(self, name, values)
+
+    def worksheet(self, title):
+        self.client._call('worksheet')
+        if title not in self._worksheets:
+            raise gspread.WorksheetNotFound(title)
+        return self._worksheets[title]
+
+    def worksheets(self):
+        self.client._call('worksheets')
+        return list(self._worksheets.values())
+
+    def add_worksheet(self, title, rows=1000, cols=26, **kw):
+        self.client._call('add_worksheet')
+        with self.lock:
+            if title in self._worksheets:
+                raise api_error(400, f'A sheet with the name "{title}" already exists. Please enter another name.', 'INVALID_ARGUMENT')
+            ws = FakeWorksheet(self, title)
+            self._worksheets[title] = ws
+        return ws
+
+    def values_batch_get(self, ranges, params=None):
+        self.client._call('values_batch_get')
+        out = []
+        for r in ranges:
+            title = r.split('!')[0].strip("'")
+            if title not in self._worksheets:
+                raise gspread.WorksheetNotFound(title)
+            out.append({'range': r, 'values': self._worksheets[title]._read(r)})
+        return {'spreadsheetId': self.id, 'valueRanges': out}
+
+    def batch_update(self, body):
+        self.client._call('spreadsheet_batch_update')
+        with self.lock:
+            self._apply(body.get('requests', []))
+        return {}
+
+    # Um lote por vez, como a API: as requisições dele entram juntas
+    def _apply(self, requests_):
+        by_id = {ws.id: ws for ws in self._worksheets.values()}
+        added = []
+        for req in requests_:
+            if 'addSheet' in req:
+                props = req['addSheet']['properties']
+                if props['title'] in self._worksheets:
+                    raise api_error(400, f'A sheet with the name "{props["title"]}" already exists. Please enter another name.', 'INVALID_ARGUMENT')
+                ws = FakeWorksheet(self, props['title'])
+                ws.id = props.get('sheetId', ws.id)
+                by_id[ws.id] = ws
+                added.append(ws)
+            elif 'deleteDimension' in req:
+                rng = req['deleteDimension']['range']
+                del by_id[rng['sheetId']].rows[rng['startIndex']:rng['endIndex']]
+            elif 'appendCells' in req:
+                by_id[req['appendCells']['sheetId']]._append([_row_data(r) for r in req['appendCells']['rows']])
+            elif 'updateCells' in req:
+                start = req['updateCells']['start']
+                by_id[start['sheetId']]._write(start.get('rowIndex', 0), start.get('columnIndex', 0),
+                                               [_row_data(r) for r in req['updateCells']['rows']])
+        # A aba nova só aparece para os outros com o lote inteiro aplicado
+        for ws in added: self._worksheets[ws.title] = ws
+
+class FakeClient:
+    # latency: segundos por chamada (número ou (mínimo, máximo) para sortear);
+    # quota: máximo de chamadas por `quota_window` segundos (None = sem limite)
+    def __init__(self, latency=0.0, quota=None, quota_window=60.0):
+        self.spreadsheets = {}
+        self.calls = collections.Counter()
+        self.latency = latency
+        self.quota = quota
+        self.quota_window = quota_window
+        self.quota_errors = 0
+        self.lock = threading.Lock()
+        self.recent = collections.deque()
+
+    def _call(self, name):
+        with self.lock:
+            now = time.monotonic()
+            if self.quota is not None:
+                while self.recent and now - self.recent[0] > self.quota_window: self.recent.popleft()
+                if len(self.recent) >= self.quota:
+                    self.quota_errors += 1
+                    raise quota_error()
+                self.recent.append(now)
+            self.calls[name] += 1
+        delay = random.uniform(*self.latency) if isinstance(self.latency, tuple) else self.latency
+        if delay: time.sleep(delay)
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+            self.recent.clear()
+            self.quota_errors = 0
+
+    def add_spreadsheet(self, key, title='Dados Automóvel', sheets=None):
+        sh = FakeSpreadsheet(self, key, title, sheets)
+        self.spreadsheets[key] = sh
+        return sh
+
+    def open_by_key(self, key):
+        self._call('open_by_key')
+        if key not in self.spreadsheets:
+            raise gspread.SpreadsheetNotFound(key)
+        return self.spreadsheets[key]
+
+    def open(self, title):
+        self._call('open')
+        for sh in self.spreadsheets.values():
+            if sh.title == title: return sh
+        raise gspread.SpreadsheetNotFound(title)
+
+# Frota sintética: n_services serviços espalhados por ~n_services/20 veículos e alguns prestadores
+def make_fleet(n_services, n_vehicles=None, n_providers=None, seed=0):
+    rnd = random.Random(seed)
+    n_vehicles = n_vehicles or max(1, min(n_services // 20, 2000))
+    n_providers = n_providers or max(1, min(n_services // 50, 300))
+    start = date(2018, 1, 1)
+
+    veiculo = [['id_veiculo', 'nome', 'placa', 'ano', 'valor_pago', 'data_compra']]
+    for i in range(1, n_vehicles + 1):
+        veiculo.append([i, f'Veículo {i}', f'BEN-{i:04d}', rnd.randint(2005, 2024), rnd.randint(20, 200) * 1000,
+                        (start + timedelta(days=rnd.randint(0, 2000))).isoformat()])
+
+    prestador = [['id_prestador', 'empresa', 'telefone', 'nome_prestador', 'cnpj', 'email', 'endereco', 'numero', 'cidade', 'bairro', 'cep']]
+    for i in range(1, n_providers + 1):
+        prestador.append([i, f'Oficina {i}', f'11 9{i:04d}-0000', f'Contato {i}', '', '', f'Rua {i}', i, f'Cidade {i % 20}', 'Centro', f'{rnd.randint(1000000, 99999999):08d}'])
+
+    servico = [['id_servico', 'id_veiculo', 'id_prestador', 'nome_servico', 'data_servico', 'garantia_dias', 'valor',
+                'km_realizado', 'km_proxima_revisao', 'registro', 'data_vencimento']]
+    for i in range(1, n_services + 1):
+        d = start + timedelta(days=rnd.randint(0, 2900))
+        garantia = rnd.choice([30, 90, 180, 365])
+        km = rnd.randint(1000, 200000)
+        servico.append([i, rnd.randint(1, n_vehicles), rnd.randint(1, n_providers), rnd.choice(['Troca de óleo', 'Revisão', 'Pneus', 'Freios', 'Alinhamento']),
+                        d.isoformat(), garantia, round(rnd.uniform(50, 3000), 2), km, km + 10000, f'NF{i}', (d + timedelta(days=garantia)).isoformat()])
+
+    return {'veiculo': veiculo, 'prestador': prestador, 'servico': servico}
+
+# keys: várias planilhas (uma frota diferente em cada), para testar o app com mais de uma frota
+def make_client(n_services=100, key=None, latency=0.0, quota=None, quota_window=60.0, keys=None, **fleet):
+    client = FakeClient(latency=latency, quota=quota, quota_window=quota_window)
+    for i, k in enumerate(keys or [key]):
+        client.add_spreadsheet(k, sheets=make_fleet(n_services, **dict(fleet, seed=fleet.get('seed', 0) + i)))
+    return client
@@ -0,0 +1,228 @@
+# ==============================================================================
+# Concorrência entre processos contra o gspread em memória (fake_gspread.py).
+# Cada "processo" é um TenantStore próprio (caches, alocador de ids, handles), todos
+# sobre a mesma planilha falsa; as threads disputam a mesma aba como processos reais.
+#
+#   python -m pytest -q test_concurrency.py
+# ==============================================================================
+
+import logging
+import threading
+import time
+
+import pytest
+import requests
+
+import app
+import fake_gspread
+
+logging.disable(logging.WARNING)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    yield install(monkeypatch, fake_gspread.make_client(50, key=app.DEFAULT_TENANT, latency=(0.0, 0.004)))
+    join_background()
+
+
+def install(monkeypatch, client):
+    local = threading.local()
+    shared = app.TenantStore()
+    governor = app.TokenBucket(10 ** 9)
+    monkeypatch.setattr(app, 'get_gspread_client', lambda: client)
+    monkeypatch.setattr(app, 'get_tenant_store', lambda: getattr(local, 'store', shared))
+    monkeypatch.setattr(app, 'get_request_governor', lambda: governor)
+    monkeypatch.setattr(app, 'TICKET_POLL', 0.05)
+    client.local = local
+    return client
+
+
+# Blocos de ids pedidos em segundo plano chegam antes de o teste seguinte trocar a planilha
+def join_background():
+    for thread in threading.enumerate():
+        if thread.name.startswith('ids-'): thread.join()
+
+
+def run_as(client, store, fn, *args, **kwargs):
+    client.local.store = store
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        del client.local.store
+
+
+# Roda cada (processo, função, args) numa thread, todas liberadas ao mesmo tempo
+def run_concurrently(client, *calls):
+    barrier = threading.Barrier(len(calls))
+    results, errors = [None] * len(calls), []
+    def worker(i, store, fn, args):
+        barrier.wait()
+        try:
+            results[i] = run_as(client, store, fn, *args)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker, args=(i,) + call) for i, call in enumerate(calls)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    if errors: raise errors[0]
+    return results
+
+
+def sheet_rows(client, sheet_name, tenant=app.DEFAULT_TENANT):
+    rows = client.spreadsheets[tenant]._worksheets[sheet_name].rows
+    return [dict(zip(rows[0], r)) for r in rows[1:] if any(r)]
+
+
+def test_conflict_on_changed_row(client):
+    a, b = app.TenantStore(), app.TenantStore()
+    run_as(client, a, app.get_sheet_data, 'servico')
+    run_as(client, b, app.get_sheet_data, 'servico')
+    run_as(client, b, app.write_sheet_delta, 'servico', [('update', 3, {'valor': 1.5})])
+
+    with pytest.raises(app.ConflictError):
+        run_as(client, a, app.write_sheet_delta, 'servico', [('update', 3, {'valor': 2.5})])
+    assert [r['valor'] for r in sheet_rows(client, 'servico') if r['id_servico'] == '3'] == ['1.5']
+
+
+def test_allocators_never_overlap(client):
+    def reserve_many(allocator):
+        return [i for _ in range(6) for i in allocator.reserve('servico', 2)]
+
+    calls = [(app.TenantStore(), reserve_many, (app.IdAllocator(block_size=3),)) for _ in range(3)]
+    ids = [i for batch in run_concurrently(client, *calls) for i in batch]
+    assert len(ids) == len(set(ids)) == 36
+    assert min(ids) > 50
+
+
+def test_inserts_take_ids_reserved_in_background(client, monkeypatch):
+    callers = []
+    reserve = app.reserve_id_block
+    def record(*args):
+        callers.append(threading.current_thread().name)
+        return reserve(*args)
+    monkeypatch.setattr(app, 'reserve_id_block', record)
+
+    allocator = app.IdAllocator(block_size=3)
+    allocator.prefetch('servico')
+    join_background()
+    ids = [allocator.next_id('servico') for _ in range(7)]
+    join_background()
+    # Cada bloco acabou sendo pedido por uma thread de fundo, nunca por quem inclui
+    assert len(set(ids)) == 7
+    assert callers and all(name == 'ids-servico' for name in callers)
+
+
+def test_concurrent_deletes_remove_the_right_ids(client):
+    a, b = app.TenantStore(), app.TenantStore()
+    for store in (a, b): run_as(client, store, app.get_sheet_data, 'servico')
+    before = {r['id_servico'] for r in sheet_rows(client, 'servico')}
+
+    results = run_concurrently(client, (a, app.write_sheet_delta, ('servico', [('delete', 3, None)])),
+                                       (b, app.write_sheet_delta, ('servico', [('delete', 10, None)])))
+    assert {r['id_servico'] for r in sheet_rows(client, 'servico')} == before - {'3', '10'}
+    # Cada escrita ganhou a sua revisão, e a segunda sabe que a cópia dela ficou defasada
+    assert sorted(revision for revision, _ in results) == [1, 2]
+    assert sorted(stale for _, stale in results) == [False, True]
+
+
+def test_writes_with_realistic_latency(monkeypatch):
+    # A vez não depende de quanto a API demora: com 150-350 ms por chamada, uma escrita
+    # sozinha passa logo e as concorrentes só esperam a vez umas das outras
+    client = install(monkeypatch, fake_gspread.make_client(50, key=app.DEFAULT_TENANT, latency=(0.15, 0.35)))
+    a, b = app.TenantStore(), app.TenantStore()
+    for store in (a, b): run_as(client, store, app.get_sheet_data, 'servico')
+    before = {r['id_servico'] for r in sheet_rows(client, 'servico')}
+
+    t0 = time.monotonic()
+    mutations = [('update', 5, {'valor': 7.5})]
+    revision, stale = run_as(client, a, app.write_sheet_delta, 'servico', mutations)
+    assert time.monotonic() - t0 < 3
+    run_as(client, a, app.get_sheet_cache).commit('servico', mutations, revision, stale)
+
+    # Senha, leitura que confirma a vez, células e fechamento (registro + revisão + fim)
+    client.reset_calls()
+    run_as(client, a, app.write_sheet_delta, 'servico', [('update', 6, {'valor': 8.5})])
+    assert sum(client.calls.values()) == 4
+
+    results = run_concurrently(client, (a, app.write_sheet_delta, ('servico', [('delete', 3, None)])),
+                                       (b, app.write_sheet_delta, ('servico', [('delete', 10, None)])))
+    assert {r['id_servico'] for r in sheet_rows(client, 'servico')} == before - {'3', '10'}
+    assert sorted(revision for revision, _ in results) == [3, 4]
+
+    calls = [(store, app.IdAllocator(block_size=2).reserve, ('servico', 2)) for store in (a, b)]
+    ids = [i for batch in run_concurrently(client, *calls) for i in batch]
+    assert len(set(ids)) == 4
+    join_background()
+
+
+def test_late_turn_writes_nothing(client, monkeypatch):
+    store = app.TenantStore()
+    run_as(client, store, app.get_sheet_data, 'servico')
+    acquire = app.acquire_turn
+    monkeypatch.setattr(app, 'acquire_turn', lambda *args, **kwargs: acquire(*args, **kwargs)._replace(deadline=0))
+
+    with pytest.raises(app.ConflictError):
+        run_as(client, store, app.write_sheet_delta, 'servico', [('update', 3, {'valor': 1.5})])
+    assert [r['valor'] for r in sheet_rows(client, 'servico') if r['id_servico'] == '3'] != ['1.5']
+    # A senha foi devolvida: a próxima escrita não espera por ela
+    monkeypatch.setattr(app, 'acquire_turn', acquire)
+    run_as(client, store, app.write_sheet_delta, 'servico', [('update', 3, {'valor': 1.5})])
+
+
+def test_write_that_landed_is_not_reported_as_failed(client, monkeypatch):
+    store = app.TenantStore()
+    run_as(client, store, app.get_sheet_data, 'servico')
+    def offline(*args, **kwargs): raise requests.ConnectionError('offline')
+    monkeypatch.setattr(app, 'finish_turn', offline)
+
+    data = dict(id_servico=500, id_veiculo=1, id_prestador=1, nome_servico='Novo', valor=10)
+    revision, stale = run_as(client, store, app.write_sheet_delta, 'servico', [('insert', 500, data)])
+    # A linha entrou: a escrita vale, e a cópia local é recarregada em vez de confiar nela
+    assert stale
+    assert [r['nome_servico'] for r in sheet_rows(client, 'servico') if r['id_servico'] == '500'] == ['Novo']
+
+
+def test_sync_reloads_on_duplicated_revision(client):
+    a = app.TenantStore()
+    run_as(client, a, app.get_sheet_data, 'servico')
+    mutation = ('update', 3, {'valor': 1.5})
+    revision, _ = run_as(client, a, app.write_sheet_delta, 'servico', [mutation])
+    cache = run_as(client, a, app.get_sheet_cache)
+    cache.apply('servico', [mutation], revision)
+
+    # Um escritor que perdeu a vez no meio deixou a id 4 alterada, registrada com a mesma revisão
+    sheet = client.spreadsheets[app.DEFAULT_TENANT]._worksheets
+    rows = sheet['servico'].rows
+    row = next(r for r in rows[1:] if r[0] == '4')
+    row[rows[0].index('valor')] = '7.5'
+    sheet[app.CHANGELOG_SHEET].rows.append(['servico', str(revision), 'update', '4', app._dump_data({'valor': 7.5}), '1'])
+
+    for entry in cache.entries.values(): entry['synced_at'] -= 999
+    df = run_as(client, a, app.get_sheet_data, 'servico')
+    assert df.loc[df.id_servico == 4, 'valor'].iloc[0] == 7.5
+    assert df.loc[df.id_servico == 3, 'valor'].iloc[0] == 1.5
+
+
+def test_sync_sees_rows_added_or_removed_by_hand(client):
+    a = app.TenantStore()
+    run_as(client, a, app.get_sheet_data, 'servico')
+    cache = run_as(client, a, app.get_sheet_cache)
+    rows = client.spreadsheets[app.DEFAULT_TENANT]._worksheets['servico'].rows
+
+    def sync():
+        for entry in cache.entries.values(): entry['synced_at'] -= 999
+        return run_as(client, a, app.get_sheet_data, 'servico')
+
+    # Sem mudança, a cópia nunca é recarregada
+    load_id = cache.entry('servico')['load_id']
+    sync(), sync()
+    assert cache.entry('servico')['load_id'] == load_id
+
+    # A primeira vez pode ser uma escrita ainda sem revisão; na segunda, a aba é recarregada
+    rows.append(['900'] + list(rows[1][1:]))
+    assert 900 not in sync()['id_servico'].tolist()
+    assert 900 in sync()['id_servico'].tolist()
+
+    del rows[2]
+    sync()
+    assert sorted(sync()['id_servico'].tolist()) == sorted(int(r['id_servico']) for r in sheet_rows(client, 'servico'))
@@ -0,0 +1,74 @@
+# ==============================================================================
+# Esquema tipado: o que é lido da planilha volta para ela igual, por qualquer caminho
+# (formulários, importação, compactação).
+#
+#   python -m pytest -q test_schema.py
+# ==============================================================================
+
+import io
+import logging
+
+import pandas as pd
+import pytest
+
+import app
+import fake_gspread
+from test_concurrency import install, join_background, sheet_rows
+
+logging.disable(logging.WARNING)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    yield install(monkeypatch, fake_gspread.make_client(20, key=app.DEFAULT_TENANT))
+    join_background()
+
+
+def test_money_round_trips_exactly():
+    # Em float32, 1234.56 voltaria como 1234.56005859375
+    df = app.coerce_frame('servico', pd.DataFrame({'id_servico': ['1'], 'valor': ['1234.56']}))
+    assert app.to_sheet_value(df['valor'].iloc[0]) == 1234.56
+    assert [app.to_sheet_value(v) for v in next(df.itertuples(index=False))][df.columns.get_loc('valor')] == 1234.56
+    assert df[['valor']].to_dict('records') == [{'valor': 1234.56}]
+    assert float(app.form_value(df.iloc[0], 'valor', 0.0)) == 1234.56
+
+
+def test_import_and_compaction_keep_money_exact(client):
+    upload = io.BytesIO("nome_servico;data_servico;valor;id_veiculo\nTroca;2024-01-31;1.234,56;1\n".encode())
+    upload.name = 'servicos.csv'
+    _, errors, written = app.import_records('servico', upload)
+    assert (errors, written) == ([], 1)
+    assert [r['valor'] for r in sheet_rows(client, 'servico') if r['nome_servico'] == 'Troca'] == ['1234.56']
+
+    app.compact_all_sheets()
+    assert [r['valor'] for r in sheet_rows(client, 'servico') if r['nome_servico'] == 'Troca'] == ['1234.56']
+    assert 1234.56 in app.get_sheet_data('servico', force_refresh=True)['valor'].tolist()
+
+
+def test_compaction_gives_ids_to_rows_without_one(client):
+    rows = client.spreadsheets[app.DEFAULT_TENANT]._worksheets['servico'].rows
+    width = len(rows[0])
+    rows.append((['', '1', '1', 'Sem id', '2024-01-31'] + [''] * width)[:width])
+    rows.append((['abc', '1', '1', 'Id inválido', '2024-02-01'] + [''] * width)[:width])
+    count = len(sheet_rows(client, 'servico'))
+
+    assert app.compact_all_sheets()
+    after = sheet_rows(client, 'servico')
+    assert len(after) == count
+    ids = [int(r['id_servico']) for r in after]
+    assert len(set(ids)) == len(ids) and min(ids) > 0
+    # Os ids novos vêm depois dos reservados, e o contador passa deles
+    new = [int(r['id_servico']) for r in after if r['nome_servico'] in ('Sem id', 'Id inválido')]
+    assert min(new) > 20
+    assert app.get_id_allocator().reserve('servico', 1)[0] > max(new)
+
+
+def test_compaction_refuses_repeated_ids(client):
+    rows = client.spreadsheets[app.DEFAULT_TENANT]._worksheets['servico'].rows
+    rows.append(list(rows[3]))
+    before = [list(r) for r in rows]
+
+    assert not app.compact_all_sheets()
+    assert rows == before
+    # A vez foi devolvida: a escrita seguinte não espera por ela
+    app.write_sheet_delta('servico', [('update', 1, {'valor': 2.5})])
@@ -0,0 +1,83 @@
+# ==============================================================================
+# Várias frotas no mesmo processo: cada uma com a sua planilha, caches e índices,
+# dentro de um orçamento de memória que despeja as usadas há mais tempo.
+#
+#   python -m pytest -q test_tenants.py
+# ==============================================================================
+
+import logging
+
+import pytest
+
+import app
+import fake_gspread
+from test_concurrency import install, join_background, run_as, sheet_rows
+
+logging.disable(logging.WARNING)
+
+FLEETS = ['frota-a', 'frota_a', 'frota-c']
+
+
+@pytest.fixture
+def client(monkeypatch):
+    yield install(monkeypatch, fake_gspread.make_client(30, keys=FLEETS))
+    join_background()
+
+
+def read(client, store, tenant, sheet_name='servico'):
+    return run_as(client, store, app.in_tenant(app.get_sheet_data, tenant), sheet_name)
+
+
+def ids(df):
+    return sorted(df['id_servico'].tolist())
+
+
+def test_fleets_never_see_each_other(client):
+    store = app.TenantStore()
+    a, b = (read(client, store, tenant) for tenant in FLEETS[:2])
+    assert a['nome_servico'].tolist() != b['nome_servico'].tolist()
+
+    mutations = [('insert', 500, dict(id_servico=500, id_veiculo=1, id_prestador=1, nome_servico='Só na A', valor=10))]
+    def write():
+        revision, stale = app.write_sheet_delta('servico', mutations)
+        app.get_sheet_cache().commit('servico', mutations, revision, stale)
+    run_as(client, store, app.in_tenant(write, FLEETS[0]))
+    assert [r['nome_servico'] for r in sheet_rows(client, 'servico', FLEETS[0]) if r['id_servico'] == '500'] == ['Só na A']
+    assert not [r for r in sheet_rows(client, 'servico', FLEETS[1]) if r['id_servico'] == '500']
+
+    for tenant in FLEETS[:2]:
+        df = read(client, store, tenant)
+        assert ids(df) == sorted(int(r['id_servico']) for r in sheet_rows(client, 'servico', tenant))
+        hits = run_as(client, store, app.in_tenant(app.search_records, tenant), 'na')
+        assert [h[1] for h in hits if h[0] == 'servico'] == ([500] if tenant == FLEETS[0] else [])
+
+
+def test_ids_that_differ_only_by_separator_get_different_files():
+    # 'frota-a' e 'frota_a' são planilhas diferentes: réplica e snapshot não podem se misturar
+    assert app.tenant_slug('frota-a') != app.tenant_slug('frota_a')
+    assert app.tenant_slug('frota-a') == app.tenant_slug('frota-a')
+
+
+def test_trim_evicts_least_recent_fleet_and_keeps_current(client):
+    store = app.TenantStore()
+    first = read(client, store, FLEETS[0])
+    store.budget = 2.5 * store.usage()[FLEETS[0]]
+    for tenant in FLEETS[1:]: read(client, store, tenant)
+
+    # A frota usada há mais tempo perdeu os dados; as outras, não
+    assert store.get(FLEETS[0], 'planilha') is None
+    assert store.get(FLEETS[1], 'planilha') is not None
+    assert store.get(FLEETS[2], 'planilha') is not None
+
+    # Ao voltar, ela recarrega igual e passa a ser a atual: sai a seguinte da fila
+    again = read(client, store, FLEETS[0])
+    assert ids(again) == ids(first)
+    assert again['valor'].tolist() == first['valor'].tolist()
+    assert store.get(FLEETS[0], 'planilha') is not None
+    assert store.get(FLEETS[1], 'planilha') is None
+
+    # Sem orçamento nenhum, a atual continua na memória
+    store.budget = 0
+    store.trim(keep=FLEETS[2])
+    assert [t for t in FLEETS if store.get(t, 'planilha') is not None] == [FLEETS[2]]
+    assert ids(read(client, store, FLEETS[1])) == sorted(int(r['id_servico']) for r in sheet_rows(client, 'servico', FLEETS[1]))